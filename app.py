@@ -1,15 +1,45 @@
-from flask import Flask, render_template, request, jsonify, send_file, redirect, url_for
+from startup_clock import IMPORT_STARTED  # first, so import time covers everything below
+from flask import (
+    Flask, render_template, request, jsonify, send_file, redirect, url_for, Response, stream_with_context,
+    abort, make_response
+)
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
-import openai
+from sqlalchemy import event as sa_event, inspect, text as sa_text, tuple_
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import defer
+from datetime import datetime, timedelta
+import base64
+import hashlib
+import click
 import os
+import sqlite3
+import sys
 from dotenv import load_dotenv
+from story_cache import create_cache
+from job_queue import JobQueue
+from demo_library import DemoLibrary
+from popularity import ThemeCounter, rebuild_theme_popularity
+from search import search_backend, search_stories, setup_search
+from pdf_export import PdfCache, pdf_filename, render_story_pdf, story_version, stream_book, stream_zip
+from metrics import Metrics, add_request_time
+from db_profile import QueryProfiler
+from compression import Compressor
+from story_archive import DuplicateId, encode_chunks, export_lines, import_lines, open_lines
+from warm_pool import create_pool
+from upstream import CircuitBreaker, RateLimiter, UpstreamUnavailable, call_with_retry, is_transient, retry_after
 import io
-from reportlab.lib.pagesizes import letter
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import inch
+import math
 import re
+import json
+import threading
+import time
+import unicodedata
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import lru_cache
+from urllib.parse import quote
+from werkzeug.http import is_resource_modified
 
 # Load environment variables
 load_dotenv()
@@ -25,6 +55,42 @@ if database_url.startswith('postgres://'):
 app.config['SQLALCHEMY_DATABASE_URI'] = database_url
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+# SQLite: WAL lets readers carry on while a story is written, and a busy timeout makes writers
+# from other workers wait for the lock instead of failing with "database is locked"
+SQLITE_WAL = os.getenv('SQLITE_WAL', 'true').lower() in ('1', 'true', 'yes')
+SQLITE_BUSY_TIMEOUT = int(os.getenv('SQLITE_BUSY_TIMEOUT', '5000'))
+
+# Connections per worker process: requests beyond pool size + overflow wait up to the pool timeout,
+# so a gevent worker serving thousands of requests can't exhaust the database's connection limit.
+# Connections are replaced after DB_POOL_RECYCLE seconds and checked before use, so ones dropped
+# by the server or a proxy are never handed to a request
+if not database_url.startswith('sqlite'):
+    engine_options = {
+        'pool_size': int(os.getenv('DB_POOL_SIZE', '5')),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', '5')),
+        'pool_timeout': float(os.getenv('DB_POOL_TIMEOUT', '30')),
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', '1800')),
+        'pool_pre_ping': os.getenv('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes')
+    }
+    # Milliseconds before PostgreSQL cancels a query (0: no limit)
+    statement_timeout = int(os.getenv('DB_STATEMENT_TIMEOUT', '0'))
+    if statement_timeout and database_url.startswith('postgresql'):
+        engine_options['connect_args'] = {'options': f'-c statement_timeout={statement_timeout}'}
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options
+
+@sa_event.listens_for(Engine, 'connect')
+def configure_sqlite_connection(dbapi_connection, connection_record):
+    """Apply the SQLite settings to each new connection"""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f'PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT}')
+    if SQLITE_WAL:
+        cursor.execute('PRAGMA journal_mode = WAL')
+        # Safe with WAL: a crash can lose the last commits but never corrupts the database
+        cursor.execute('PRAGMA synchronous = NORMAL')
+    cursor.close()
+
 db = SQLAlchemy(app)
 
 # Initialize OpenAI
@@ -32,60 +98,774 @@ openai_api_key = os.getenv('OPENAI_API_KEY')
 DEMO_MODE = not openai_api_key
 
 if DEMO_MODE:
-    print("🔶 DEMO MODE: Running without OpenAI API key")
-    print("   - Sample stories will be generated instead of AI stories")
-    print("   - To enable full AI functionality, set OPENAI_API_KEY environment variable")
-    print("   - Get an API key from: https://platform.openai.com/api-keys")
+    print("🔶 DEMO MODE: Running without OpenAI API key", file=sys.stderr)
+    print("   - Sample stories will be generated instead of AI stories", file=sys.stderr)
+    print("   - To enable full AI functionality, set OPENAI_API_KEY environment variable", file=sys.stderr)
+    print("   - Get an API key from: https://platform.openai.com/api-keys", file=sys.stderr)
 else:
-    print("✅ OpenAI API key found - Full AI functionality enabled")
-    openai.api_key = openai_api_key
+    print("✅ OpenAI API key found - Full AI functionality enabled", file=sys.stderr)
+
+@lru_cache(maxsize=None)
+def demo_library():
+    """Demo story templates, read and compiled once per process"""
+    return DemoLibrary.load(DEMO_STORIES_DIR)
+
+@lru_cache(maxsize=None)
+def openai_client():
+    """Shared OpenAI client, created on first use since most requests never need it.
+
+    Its HTTP connections are pooled and kept alive, so concurrent requests in
+    a worker reuse warm TLS connections up to OPENAI_MAX_CONNECTIONS.
+    """
+    import httpx
+    import openai
+    return openai.OpenAI(
+        api_key=openai_api_key,
+        # Retries are handled by StoryGenerator so they can respect the rate limiter
+        max_retries=0,
+        http_client=httpx.Client(
+            timeout=OPENAI_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENAI_MAX_CONNECTIONS
+            )
+        )
+    )
+
+# Delay between streamed chunks in demo mode, so streaming can be exercised realistically
+DEMO_STREAM_DELAY = float(os.getenv('DEMO_STREAM_DELAY', '0.02'))
+
+# Demo story templates, one text file per story
+DEMO_STORIES_DIR = os.getenv('DEMO_STORIES_DIR', os.path.join(app.root_path, 'demo_stories'))
+
+# 'separate' asks for the story and then the title in two completions;
+# 'combined' gets both from one completion and only falls back to a title request
+GENERATION_MODE = os.getenv('GENERATION_MODE', 'separate').lower()
+if GENERATION_MODE not in ('separate', 'combined'):
+    raise ValueError(f"GENERATION_MODE must be 'separate' or 'combined', got {GENERATION_MODE!r}")
+
+# Generation result cache: 'off' (default), 'memory' (per worker) or 'sqlite' (shared by all workers)
+STORY_CACHE = os.getenv('STORY_CACHE', 'off')
+STORY_CACHE_PATH = os.getenv('STORY_CACHE_PATH', os.path.join(app.instance_path, 'story_cache.db'))
+STORY_CACHE_TTL = int(os.getenv('STORY_CACHE_TTL', '86400'))
+STORY_CACHE_MAX_KEYS = int(os.getenv('STORY_CACHE_MAX_KEYS', '500'))
+STORY_CACHE_VARIANTS = int(os.getenv('STORY_CACHE_VARIANTS', '3'))
+
+# Background generation: with GENERATION_ASYNC on, /generate queues a job and returns its id
+GENERATION_ASYNC = os.getenv('GENERATION_ASYNC', 'false').lower() in ('1', 'true', 'yes')
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '2'))
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', '1.0'))
+JOB_LEASE_SECONDS = int(os.getenv('JOB_LEASE_SECONDS', '300'))
+# Finished jobs are deleted after this many seconds (0 keeps them)
+JOB_RETENTION_SECONDS = int(os.getenv('JOB_RETENTION_SECONDS', str(7 * 24 * 3600)))
+
+# Rendered PDFs are cached in memory, and in PDF_CACHE_DIR (if set) for all workers
+PDF_CACHE_MAX_BYTES = int(os.getenv('PDF_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+PDF_CACHE_DIR = os.getenv('PDF_CACHE_DIR') or None
+PDF_EXPORT_MAX_STORIES = int(os.getenv('PDF_EXPORT_MAX_STORIES', '100'))
+
+# Theme popularity is upserted with each story, or batched every N seconds when set
+THEME_COUNT_FLUSH_SECONDS = float(os.getenv('THEME_COUNT_FLUSH_SECONDS', '0'))
+
+# /stories uses numbered pages ('offset') or newest-first cursors ('keyset')
+STORIES_PAGINATION = os.getenv('STORIES_PAGINATION', 'offset').lower()
+
+# OpenAI call protection: per-attempt timeout, retries of transient errors with jittered backoff,
+# shared requests/tokens per minute budgets (0 = unlimited) and a circuit breaker
+OPENAI_TIMEOUT = float(os.getenv('OPENAI_TIMEOUT', '30'))
+OPENAI_MAX_CONNECTIONS = int(os.getenv('OPENAI_MAX_CONNECTIONS', '100'))
+OPENAI_MAX_RETRIES = int(os.getenv('OPENAI_MAX_RETRIES', '3'))
+OPENAI_RETRY_BASE_DELAY = float(os.getenv('OPENAI_RETRY_BASE_DELAY', '0.5'))
+OPENAI_RPM = int(os.getenv('OPENAI_RPM', '0'))
+OPENAI_TPM = int(os.getenv('OPENAI_TPM', '0'))
+OPENAI_MAX_WAIT = float(os.getenv('OPENAI_MAX_WAIT', '10'))
+RATE_LIMIT_PATH = os.getenv('RATE_LIMIT_PATH', os.path.join(app.instance_path, 'rate_limit.db')) or None
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '5'))
+CIRCUIT_RESET_SECONDS = float(os.getenv('CIRCUIT_RESET_SECONDS', '30'))
+
+# Token budgets: a story's max_tokens is its target word count x tokens per word x headroom
+TOKENS_PER_WORD = float(os.getenv('TOKENS_PER_WORD', '1.35'))
+TOKEN_BUDGET_HEADROOM = float(os.getenv('TOKEN_BUDGET_HEADROOM', '1.25'))
+# Dollars per 1K tokens, for the cost estimates in /api/usage
+OPENAI_PROMPT_PRICE = float(os.getenv('OPENAI_PROMPT_PRICE', '0.0005'))
+OPENAI_COMPLETION_PRICE = float(os.getenv('OPENAI_COMPLETION_PRICE', '0.0015'))
+
+# Batch generation: stories per request, and OpenAI calls in flight per batch
+BATCH_MAX_STORIES = int(os.getenv('BATCH_MAX_STORIES', '50'))
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', '4'))
+
+# Warm pool: stories generated ahead of time for the most requested popular combinations (0 disables)
+WARM_POOL_SIZE = int(os.getenv('WARM_POOL_SIZE', '0'))
+WARM_POOL_THEMES = int(os.getenv('WARM_POOL_THEMES', '10'))
+WARM_POOL_MAX_PER_KEY = int(os.getenv('WARM_POOL_MAX_PER_KEY', '5'))
+WARM_POOL_BUDGET = int(os.getenv('WARM_POOL_BUDGET', '60'))
+WARM_POOL_INTERVAL = float(os.getenv('WARM_POOL_INTERVAL', '10'))
+WARM_POOL_WINDOW = int(os.getenv('WARM_POOL_WINDOW', '3600'))
+WARM_POOL_MAX_LIVE = int(os.getenv('WARM_POOL_MAX_LIVE', '0'))
+WARM_POOL_MAX_AGE = int(os.getenv('WARM_POOL_MAX_AGE', '86400'))
+WARM_POOL_PATH = os.getenv('WARM_POOL_PATH', os.path.join(app.instance_path, 'warm_pool.db')) or None
+
+# Metrics: set METRICS_DIR so /metrics adds up every gunicorn worker
+METRICS_DIR = os.getenv('METRICS_DIR') or None
+METRICS_FLUSH_SECONDS = float(os.getenv('METRICS_FLUSH_SECONDS', '5'))
+SERVER_TIMING = os.getenv('SERVER_TIMING', 'false').lower() in ('1', 'true', 'yes')
+
+# Query profiling for development: logs queries and database time per request, slow queries and N+1 repeats
+DB_PROFILE = os.getenv('DB_PROFILE', 'false').lower() in ('1', 'true', 'yes')
+DB_SLOW_QUERY_MS = float(os.getenv('DB_SLOW_QUERY_MS', '100'))
+DB_REPEAT_THRESHOLD = int(os.getenv('DB_REPEAT_THRESHOLD', '5'))
+
+# HTTP caching: story pages and PDFs are revalidated with ETags; the theme list may be cached by a CDN
+STORY_MAX_AGE = int(os.getenv('STORY_MAX_AGE', '0'))
+THEMES_MAX_AGE = int(os.getenv('THEMES_MAX_AGE', '60'))
+THEMES_CDN_MAX_AGE = int(os.getenv('THEMES_CDN_MAX_AGE', '300'))
+
+# Response compression: gzip, or brotli when installed, for responses of at least COMPRESS_MIN_SIZE bytes
+COMPRESSION = os.getenv('COMPRESSION', 'true').lower() in ('1', 'true', 'yes')
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', '1024'))
+COMPRESS_LEVEL = int(os.getenv('COMPRESS_LEVEL', '6'))
+BROTLI_QUALITY = int(os.getenv('BROTLI_QUALITY', '5'))
+COMPRESS_CACHE_MAX_BYTES = int(os.getenv('COMPRESS_CACHE_MAX_BYTES', str(16 * 1024 * 1024)))
+
+metrics = Metrics(directory=METRICS_DIR, flush_interval=METRICS_FLUSH_SECONDS, server_timing=SERVER_TIMING)
+metrics.init_app(app)
+
+query_profiler = QueryProfiler(slow_query_ms=DB_SLOW_QUERY_MS, repeat_threshold=DB_REPEAT_THRESHOLD)
+if DB_PROFILE:
+    query_profiler.init_app(app)
+
+# Registered after metrics, so request timings include compression
+compressor = Compressor(
+    min_size=COMPRESS_MIN_SIZE,
+    gzip_level=COMPRESS_LEVEL,
+    brotli_quality=BROTLI_QUALITY,
+    cache_max_bytes=COMPRESS_CACHE_MAX_BYTES
+)
+if COMPRESSION:
+    compressor.init_app(app)
+
+TITLE_LINE_RE = re.compile(r'^\s*\**\s*title\s*:\s*(.+?)\s*\**\s*$', re.IGNORECASE)
+SAFE_FILENAME_RE = re.compile(r'[^\w.-]+')
+SENTENCE_END_RE = re.compile(r'[.!?]["\'\u201d\u2019)]*(?=\s|$)')
+
+# Stories are asked to finish with this line, and completions stop as soon as it starts
+STORY_END = 'The End'
+
+def trim_to_sentence(text):
+    """Cut a story that ran out of tokens after its last complete sentence"""
+    last = None
+    for last in SENTENCE_END_RE.finditer(text):
+        pass
+    if last is not None and last.end() > len(text) // 2:
+        return text[:last.end()]
+    return text
 
 # Database Models
 class Story(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(200), nullable=False)
     content = db.Column(db.Text, nullable=False)
-    theme = db.Column(db.String(100), nullable=False)
+    theme = db.Column(db.String(100), nullable=False, index=True)
     age_group = db.Column(db.String(20), nullable=False)
-    child_name = db.Column(db.String(50), nullable=True)
+    child_name = db.Column(db.String(50), nullable=True, index=True)
     story_length = db.Column(db.String(20), default='medium')
     created_date = db.Column(db.DateTime, default=datetime.utcnow)
     user_notes = db.Column(db.Text, nullable=True)
+    # Bumped on every edit; HTTP validators for the story page and PDF are built from these
+    version = db.Column(db.Integer, nullable=False, default=1)
+    updated_date = db.Column(db.DateTime, default=datetime.utcnow)
+    # OpenAI tokens and time spent generating the story; tokens are empty when no completion was needed
+    prompt_tokens = db.Column(db.Integer, nullable=True)
+    completion_tokens = db.Column(db.Integer, nullable=True)
+    generation_ms = db.Column(db.Integer, nullable=True)
+    # Derived from content at save time so listings never need the full text
+    summary = db.Column(db.String(200), nullable=True)
+    word_count = db.Column(db.Integer, nullable=True)
+    reading_minutes = db.Column(db.Integer, nullable=True)
+
+    __table_args__ = (
+        # Serves newest-first listings and keyset pagination on (created_date, id)
+        db.Index('ix_story_created_date_id', 'created_date', 'id'),
+    )
+
+    def update_derived_fields(self):
+        """Recompute the summary, word count and reading time from the content"""
+        for field, value in derived_story_fields(self.content).items():
+            setattr(self, field, value)
+
+    def touch(self):
+        """Mark the story as changed so cached copies are revalidated"""
+        self.version = (self.version or 1) + 1
+        self.updated_date = datetime.utcnow()
 
     def __repr__(self):
         return f'<Story {self.title}>'
 
+def story_summary(content, limit=160):
+    """Opening of a story, cut at a word boundary"""
+    text = ' '.join(content.split())
+    if len(text) <= limit:
+        return text
+    return text[:limit].rsplit(' ', 1)[0] + '...'
+
+def derived_story_fields(content):
+    """Summary, word count and reading time for a story's text"""
+    word_count = len(content.split())
+    return {
+        'summary': story_summary(content),
+        'word_count': word_count,
+        'reading_minutes': story_generator.reading_minutes(word_count)
+    }
+
+@sa_event.listens_for(Story, 'before_insert')
+def _derive_on_insert(mapper, connection, story):
+    story.update_derived_fields()
+
+@sa_event.listens_for(Story, 'before_update')
+def _derive_on_update(mapper, connection, story):
+    if inspect(story).attrs.content.history.has_changes():
+        story.update_derived_fields()
+
+def listing_query():
+    """Story query for listings, leaving the long text columns unloaded"""
+    return Story.query.options(defer(Story.content), defer(Story.user_notes))
+
 class Theme(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False, unique=True)
     description = db.Column(db.Text, nullable=True)
     category = db.Column(db.String(50), nullable=False)
-    popularity_score = db.Column(db.Integer, default=0)
+    popularity_score = db.Column(db.Integer, default=0, index=True)
 
     def __repr__(self):
         return f'<Theme {self.name}>'
 
+class StoryJob(db.Model):
+    id = db.Column(db.String(32), primary_key=True)
+    status = db.Column(db.String(20), nullable=False, default='queued', index=True)
+    theme = db.Column(db.String(100), nullable=False)
+    age_group = db.Column(db.String(20), nullable=False)
+    child_name = db.Column(db.String(50), nullable=True)
+    story_length = db.Column(db.String(20), default='medium')
+    story_id = db.Column(db.Integer, nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    created_date = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    started_date = db.Column(db.DateTime, nullable=True)
+    finished_date = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        return f'<StoryJob {self.id} {self.status}>'
+
+class TokenUsage:
+    """Tokens used by the OpenAI calls behind one story, which may run on several threads"""
+    
+    def __init__(self):
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.calls = 0
+        self._lock = threading.Lock()
+    
+    def count_call(self):
+        with self._lock:
+            self.calls += 1
+    
+    def add(self, prompt_tokens, completion_tokens):
+        with self._lock:
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+    
+    def as_dict(self):
+        with self._lock:
+            return {'prompt_tokens': self.prompt_tokens, 'completion_tokens': self.completion_tokens}
+
 # Story Generation Service
 class StoryGenerator:
-    def __init__(self):
+    def __init__(self, cache=None, limiter=None, breaker=None, pool=None):
+        self.cache = cache
+        self.pool = pool
+        self.limiter = limiter or RateLimiter()
+        self.breaker = breaker or CircuitBreaker(failure_threshold=0)
         self.length_configs = {
-            'short': {'words': 200, 'description': '2-3 minutes'},
-            'medium': {'words': 400, 'description': '5-7 minutes'},
-            'long': {'words': 600, 'description': '8-10 minutes'}
+            'short': {'words': 200, 'description': '2-3 minutes', 'minutes': (2, 3)},
+            'medium': {'words': 400, 'description': '5-7 minutes', 'minutes': (5, 7)},
+            'long': {'words': 600, 'description': '8-10 minutes', 'minutes': (8, 10)}
         }
+        # Read-aloud pace implied by the configured lengths
+        paces = [c['words'] / (sum(c['minutes']) / 2) for c in self.length_configs.values()]
+        self.words_per_minute = sum(paces) / len(paces)
+        self._executor = None
+        self._stats = {}
+        self._stats_lock = threading.Lock()
     
-    def generate_story(self, theme, age_group, child_name=None, story_length='medium'):
-        """Generate a bedtime story using OpenAI API or demo mode"""
+    def generate_story(self, theme, age_group, child_name=None, story_length='medium', fresh=False):
+        """Generate a bedtime story using OpenAI API or demo mode.
         
+        ``fresh`` skips the warm pool and the cache, as the pool's own refills do.
+        """
+        started = time.perf_counter()
+        result = self._generate(theme, age_group, child_name, story_length, fresh)
+        result.setdefault('generation_ms', round((time.perf_counter() - started) * 1000, 1))
+        return result
+    
+    def _generate(self, theme, age_group, child_name, story_length, fresh):
         # Check if we're in demo mode
         if DEMO_MODE:
+            metrics.inc('story_generations_total', source='demo', outcome='ok')
             return self._generate_demo_story(theme, age_group, child_name, story_length)
         
+        if not fresh:
+            pooled = self._pool_take(theme, age_group, child_name, story_length)
+            if pooled:
+                metrics.inc('story_generations_total', source='pool', outcome='ok')
+                return pooled
+            
+            cached = self._cache_lookup(theme, age_group, child_name, story_length)
+            if cached:
+                metrics.inc('story_generations_total', source='cache', outcome='ok')
+                return cached
+        
+        with self._live_generation(fresh):
+            return self._generate_live(theme, age_group, child_name, story_length, fresh)
+    
+    def _generate_live(self, theme, age_group, child_name, story_length, fresh):
+        """Generate a story with OpenAI, degrading to a fallback story if it is unavailable"""
+        started = time.perf_counter()
+        tokens = TokenUsage()
+        try:
+            if GENERATION_MODE == 'combined':
+                # Drain the combined stream so the title fallback can overlap the story
+                for event in self._stream_combined(theme, age_group, child_name, story_length, tokens):
+                    if event['type'] == 'done':
+                        result = event
+                result.pop('type')
+            else:
+                response = self._complete(
+                    'story',
+                    tokens=tokens,
+                    model="gpt-3.5-turbo",
+                    messages=self._story_messages(theme, age_group, child_name, story_length),
+                    max_tokens=self.token_budget(story_length, age_group),
+                    stop=['\n' + STORY_END],
+                    temperature=0.7
+                )
+                
+                choice = response.choices[0]
+                result = {
+                    'title': self._generate_title(theme, tokens),
+                    'content': choice.message.content.strip(),
+                    'success': True,
+                    'truncated': choice.finish_reason == 'length'
+                }
+            
+            if result['truncated']:
+                app.logger.warning('Story ran out of tokens (length=%s, age=%s)', story_length, age_group)
+                result['content'] = trim_to_sentence(result['content'])
+            result.update(tokens.as_dict(), openai_calls=tokens.calls)
+            
+            if not fresh:
+                self._cache_store(theme, age_group, child_name, story_length, result)
+            metrics.inc('story_generations_total', source='pool_refill' if fresh else 'openai', outcome='ok')
+            return self._record_latency(result, started)
+            
+        except Exception as e:
+            metrics.inc('story_generations_total', source='pool_refill' if fresh else 'openai', outcome=type(e).__name__)
+            if not fresh and self._can_degrade(e):
+                return self._degraded_story(theme, age_group, child_name, story_length, e)
+            return dict(self._error_result(e), openai_calls=tokens.calls)
+    
+    def stream_story(self, theme, age_group, child_name=None, story_length='medium'):
+        """Generate a story incrementally.
+
+        Yields ``{'type': 'chunk', 'text': ...}`` events as the story text
+        arrives, followed by a single final event that carries the same
+        fields as ``generate_story`` (``type`` is ``'done'`` on success and
+        ``'error'`` otherwise).
+        """
+        started = time.perf_counter()
+        for event in self._stream_events(theme, age_group, child_name, story_length):
+            if event['type'] == 'done':
+                event.setdefault('generation_ms', round((time.perf_counter() - started) * 1000, 1))
+            yield event
+    
+    def _stream_events(self, theme, age_group, child_name, story_length):
+        if DEMO_MODE:
+            metrics.inc('story_generations_total', source='demo', outcome='ok')
+            result = self._generate_demo_story(theme, age_group, child_name, story_length)
+            yield from self._replay(result, delay=DEMO_STREAM_DELAY)
+            return
+        
+        pooled = self._pool_take(theme, age_group, child_name, story_length)
+        if pooled:
+            metrics.inc('story_generations_total', source='pool', outcome='ok')
+            yield from self._replay(pooled)
+            return
+        
+        cached = self._cache_lookup(theme, age_group, child_name, story_length)
+        if cached:
+            metrics.inc('story_generations_total', source='cache', outcome='ok')
+            yield from self._replay(cached)
+            return
+        
+        yield from self._stream_live(theme, age_group, child_name, story_length)
+    
+    def _stream_live(self, theme, age_group, child_name, story_length):
+        """Stream a story from OpenAI, degrading to a fallback story if it fails before any text is sent"""
+        started = time.perf_counter()
+        streamed = False
+        tokens = TokenUsage()
         try:
-            # Build the prompt
-            word_count = self.length_configs[story_length]['words']
+            if GENERATION_MODE == 'combined':
+                events = self._stream_combined(theme, age_group, child_name, story_length, tokens)
+            else:
+                events = self._stream_separate(theme, age_group, child_name, story_length, tokens)
             
-            prompt = f"""Create a gentle, calming bedtime story for a {age_group}-year-old child.
+            # Counted as live for as long as the story streams, so pool refills hold back
+            with self._live_generation(False):
+                for event in events:
+                    streamed = True
+                    if event['type'] == 'done':
+                        # Text already sent can't be trimmed, so a truncated story is only flagged
+                        event.update(tokens.as_dict())
+                        self._cache_store(theme, age_group, child_name, story_length, event)
+                        metrics.inc('story_generations_total', source='openai', outcome='ok')
+                        self._record_latency(event, started)
+                    yield event
+            
+        except Exception as e:
+            metrics.inc('story_generations_total', source='openai', outcome=type(e).__name__)
+            # Once text has been sent the story can't be swapped for a fallback
+            if streamed or not self._can_degrade(e):
+                yield dict(self._error_result(e), type='error')
+            else:
+                yield from self._replay(self._degraded_story(theme, age_group, child_name, story_length, e))
+    
+    def _replay(self, result, delay=0):
+        """Stream a ready-made story in small chunks, as if it were being generated"""
+        for text in self._chunk_text(result['content']):
+            yield {'type': 'chunk', 'text': text}
+            if delay:
+                time.sleep(delay)
+        yield dict(result, type='done')
+    
+    def reading_minutes(self, word_count):
+        """Estimated read-aloud time for a story of the given length"""
+        return max(1, round(word_count / self.words_per_minute))
+    
+    def token_budget(self, story_length, age_group):
+        """max_tokens for a story: its target length plus headroom to reach the ending"""
+        words = self.length_configs[story_length]['words']
+        try:
+            age = int(age_group)
+        except (TypeError, ValueError):
+            age = 6
+        # Stories for older children use longer words, which take more tokens each
+        tokens_per_word = TOKENS_PER_WORD * (0.9 if age <= 5 else 1.1 if age >= 9 else 1.0)
+        return math.ceil(words * tokens_per_word * TOKEN_BUDGET_HEADROOM)
+    
+    def generation_stats(self):
+        """Average generation latency per mode, for comparing the two modes"""
+        with self._stats_lock:
+            return {
+                mode: {
+                    'count': stats['count'],
+                    'avg_ms': round(stats['total_ms'] / stats['count'], 1),
+                    'title_fallbacks': stats['title_fallbacks']
+                }
+                for mode, stats in self._stats.items()
+            }
+    
+    def _pool_take(self, theme, age_group, child_name, story_length):
+        """Return a pre-generated, personalized result from the warm pool or None"""
+        if self.pool is None:
+            return None
+        
+        pooled = self.pool.take(theme, age_group, child_name, story_length)
+        if pooled is None:
+            return None
+        return dict(pooled, success=True, pooled=True)
+    
+    def _live_generation(self, fresh):
+        """Let the warm pool know a user is waiting on OpenAI, so it holds off refilling"""
+        if self.pool is None or fresh:
+            return nullcontext()
+        return self.pool.live()
+    
+    def _cache_lookup(self, theme, age_group, child_name, story_length):
+        """Return a cached, personalized result or None"""
+        if self.cache is None:
+            return None
+        
+        cached = self.cache.lookup(theme, age_group, child_name, story_length)
+        if cached is None:
+            return None
+        return dict(cached, success=True, cached=True)
+    
+    def _cache_store(self, theme, age_group, child_name, story_length, result):
+        """Offer a freshly generated result to the cache"""
+        if self.cache is not None:
+            self.cache.store(theme, age_group, child_name, story_length, result)
+    
+    def _stream_separate(self, theme, age_group, child_name, story_length, tokens=None):
+        """Stream the story completion, then request the title"""
+        stream = self._complete(
+            'story',
+            tokens=tokens,
+            model="gpt-3.5-turbo",
+            messages=self._story_messages(theme, age_group, child_name, story_length),
+            max_tokens=self.token_budget(story_length, age_group),
+            stop=['\n' + STORY_END],
+            temperature=0.7,
+            stream=True
+        )
+        
+        parts = []
+        finish = []
+        for text in self._stream_text(stream, finish):
+            parts.append(text)
+            yield {'type': 'chunk', 'text': text}
+        
+        yield {
+            'type': 'done',
+            'title': self._generate_title(theme, tokens),
+            'content': ''.join(parts).strip(),
+            'success': True,
+            'truncated': finish == ['length']
+        }
+    
+    def _stream_combined(self, theme, age_group, child_name, story_length, tokens=None):
+        """Stream a single completion that carries both the title and the story.
+
+        The first line is expected to be ``Title: ...``. If it is not, a
+        separate title request is started right away and runs while the rest
+        of the story is still streaming.
+        """
+        messages = self._story_messages(theme, age_group, child_name, story_length)
+        messages[-1]['content'] += (
+            '\n\nStart your reply with the title on its own line, written as '
+            '"Title: <a short, appealing title of at most 6 words>", '
+            'followed by a blank line and then the story.'
+        )
+        
+        stream = self._complete(
+            'story',
+            tokens=tokens,
+            model="gpt-3.5-turbo",
+            messages=messages,
+            # Room for the title line as well
+            max_tokens=self.token_budget(story_length, age_group) + 20,
+            stop=['\n' + STORY_END],
+            temperature=0.7,
+            stream=True
+        )
+        
+        title = None
+        title_future = None
+        head = ''
+        parts = []
+        finish = []
+        for text in self._stream_text(stream, finish):
+            if title is None and title_future is None:
+                head += text
+                if '\n' not in head and len(head) < 200:
+                    continue
+                
+                first_line, _, rest = head.partition('\n')
+                match = TITLE_LINE_RE.match(first_line)
+                if match:
+                    title = match.group(1).strip().strip('"')
+                    text = rest.lstrip('\n')
+                else:
+                    title_future = self._title_executor().submit(self._generate_title, theme, tokens)
+                    text = head
+                if not text:
+                    continue
+            
+            parts.append(text)
+            yield {'type': 'chunk', 'text': text}
+        
+        if title is None and title_future is None:
+            # The completion ended before the first line break
+            match = TITLE_LINE_RE.match(head)
+            if match:
+                title = match.group(1).strip().strip('"')
+            else:
+                parts.append(head)
+                yield {'type': 'chunk', 'text': head}
+                title_future = self._title_executor().submit(self._generate_title, theme, tokens)
+        
+        if title_future is not None:
+            title = title_future.result()
+        
+        yield {
+            'type': 'done',
+            'title': title,
+            'content': ''.join(parts).strip(),
+            'success': True,
+            'title_fallback': title_future is not None,
+            'truncated': finish == ['length']
+        }
+    
+    def _complete(self, call, tokens=None, **kwargs):
+        """Create a chat completion behind the circuit breaker, rate limiter and retries.
+        
+        Every attempt is recorded with its duration, tokens and outcome. Attempts
+        and tokens are also added to ``tokens``, a TokenUsage, when one is given.
+        """
+        self.breaker.before_call()
+        prompt_tokens = sum(len(m['content']) for m in kwargs['messages']) // 4
+        reserved = prompt_tokens + kwargs.get('max_tokens', 0)
+        
+        response, started = self._with_retries(call, lambda: self._attempt(call, reserved, kwargs, tokens))
+        self.breaker.record_success()
+        if kwargs.get('stream'):
+            return self._timed_stream(call, response, started, prompt_tokens, reserved, tokens)
+        
+        self._record_call(call, started, 'ok', response.usage, tokens=tokens)
+        if response.usage is not None:
+            self.limiter.refund(reserved - response.usage.total_tokens)
+        return response
+    
+    def _attempt(self, call, reserved, kwargs, tokens=None):
+        """One completion request within the rate limiter's budget; returns (response, started)"""
+        self.limiter.acquire(reserved)
+        if tokens is not None:
+            tokens.count_call()
+        started = time.perf_counter()
+        try:
+            response = openai_client().chat.completions.create(timeout=OPENAI_TIMEOUT, **kwargs)
+        except Exception as e:
+            self._record_call(call, started, type(e).__name__)
+            self.limiter.refund(reserved)
+            if getattr(e, 'status_code', None) == 429 and is_transient(e):
+                # Upstream is throttling this key, so hold back every worker. An exhausted quota
+                # is also a 429, but waiting won't fix it
+                self.limiter.pause(retry_after(e) or 1.0)
+            raise
+        return response, started
+    
+    def _with_retries(self, call, attempt):
+        """Run ``attempt`` with retries, telling the circuit breaker how it failed"""
+        def log_retry(error, delay):
+            app.logger.warning('OpenAI %s call failed (%s); retrying in %.1fs', call, type(error).__name__, delay)
+        
+        try:
+            return call_with_retry(
+                attempt, max_retries=OPENAI_MAX_RETRIES, base_delay=OPENAI_RETRY_BASE_DELAY, on_retry=log_retry
+            )
+        except UpstreamUnavailable:
+            self.breaker.cancel_call()
+            raise
+        except Exception as e:
+            self._record_breaker(e)
+            raise
+    
+    def _timed_stream(self, call, stream, started, prompt_tokens, reserved, tokens=None):
+        """Pass a completion stream through, recording it once it has been read"""
+        chunks = 0
+        outcome = 'cancelled'
+        try:
+            for chunk in stream:
+                chunks += 1
+                yield chunk
+            outcome = 'ok'
+        except Exception as e:
+            outcome = type(e).__name__
+            self._record_breaker(e)
+            raise
+        finally:
+            # Streams carry no usage, but each content chunk is about one token
+            completion_tokens = max(chunks - 2, 0)
+            self._record_call(
+                call, started, outcome,
+                completion_tokens=completion_tokens, prompt_tokens=prompt_tokens, tokens=tokens
+            )
+            self.limiter.refund(reserved - prompt_tokens - completion_tokens)
+    
+    def _record_breaker(self, error):
+        """Count transient failures towards opening the circuit; any other error means upstream answered"""
+        if is_transient(error):
+            self.breaker.record_failure(error)
+        else:
+            self.breaker.record_success()
+    
+    def _can_degrade(self, error):
+        """Whether a failure should be answered with a fallback story instead of an error"""
+        return isinstance(error, UpstreamUnavailable) or is_transient(error)
+    
+    def _degraded_story(self, theme, age_group, child_name, story_length, error):
+        """Serve a cached story, or a demo story, while OpenAI is unavailable"""
+        app.logger.warning('OpenAI unavailable (%s); serving a fallback story', type(error).__name__)
+        result = None
+        if self.cache is not None:
+            result = self.cache.lookup(theme, age_group, child_name, story_length, partial=True)
+        if result is not None:
+            result = dict(result, success=True, cached=True)
+            metrics.inc('story_generations_total', source='fallback_cache', outcome='ok')
+        else:
+            result = self._generate_demo_story(theme, age_group, child_name, story_length)
+            metrics.inc('story_generations_total', source='fallback_demo', outcome='ok')
+        return dict(result, degraded=True)
+    
+    def _record_call(self, call, started, outcome, usage=None, completion_tokens=0, prompt_tokens=0, tokens=None):
+        elapsed = time.perf_counter() - started
+        metrics.observe('openai_request_duration_seconds', elapsed, call=call, outcome=outcome)
+        add_request_time('openai', elapsed)
+        if usage is not None:
+            metrics.inc('openai_tokens_total', usage.prompt_tokens, call=call, kind='prompt')
+            prompt_tokens = usage.prompt_tokens
+            completion_tokens = usage.completion_tokens
+        if completion_tokens:
+            metrics.inc('openai_tokens_total', completion_tokens, call=call, kind='completion')
+        if tokens is not None and (prompt_tokens or completion_tokens):
+            tokens.add(prompt_tokens, completion_tokens)
+    
+    @staticmethod
+    def _stream_text(stream, finish=None):
+        """Yield the non-empty text deltas of a streamed chat completion.
+        
+        The finish reason is appended to ``finish`` when the stream reports one.
+        """
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            if finish is not None and choice.finish_reason:
+                finish.append(choice.finish_reason)
+            text = choice.delta.content
+            if text:
+                yield text
+    
+    def _title_executor(self):
+        """Thread pool for title requests that run alongside a story stream"""
+        with self._stats_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='story-title')
+            return self._executor
+    
+    def _record_latency(self, result, started):
+        """Attach the generation latency to a result and add it to the per-mode stats"""
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        result['generation_ms'] = round(elapsed_ms, 1)
+        result['generation_mode'] = GENERATION_MODE
+        
+        with self._stats_lock:
+            stats = self._stats.setdefault(
+                GENERATION_MODE, {'count': 0, 'total_ms': 0.0, 'title_fallbacks': 0}
+            )
+            stats['count'] += 1
+            stats['total_ms'] += elapsed_ms
+            if result.get('title_fallback'):
+                stats['title_fallbacks'] += 1
+        
+        app.logger.info('Generated story in %.0f ms (mode=%s)', elapsed_ms, GENERATION_MODE)
+        return result
+    
+    def _story_messages(self, theme, age_group, child_name, story_length):
+        """Build the chat messages for the story completion"""
+        word_count = self.length_configs[story_length]['words']
+        
+        prompt = f"""Create a gentle, calming bedtime story for a {age_group}-year-old child.
             
 Theme: {theme}
 Length: Approximately {word_count} words
@@ -99,238 +879,178 @@ Requirements:
 - Clear beginning, middle, and end
 - Use simple language appropriate for the age group
 - If a child's name is provided, make them the main character
-- End with a peaceful, sleepy conclusion
+- End with a peaceful, sleepy conclusion, then write "{STORY_END}." on its own line
 
 Please write the story now:"""
 
-            response = openai.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": "You are a skilled children's author who specializes in creating gentle, educational bedtime stories. Always create content that is completely appropriate for children and promotes positive values."},
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens=800,
-                temperature=0.7
-            )
-            
-            story_content = response.choices[0].message.content.strip()
-            
-            # Generate a title
-            title_prompt = f"Create a short, appealing title (maximum 6 words) for this bedtime story about {theme}:"
-            
-            title_response = openai.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": "You create short, child-friendly story titles."},
-                    {"role": "user", "content": title_prompt}
-                ],
-                max_tokens=20,
-                temperature=0.5
-            )
-            
-            title = title_response.choices[0].message.content.strip().strip('"')
-            
+        return [
+            {"role": "system", "content": "You are a skilled children's author who specializes in creating gentle, educational bedtime stories. Always create content that is completely appropriate for children and promotes positive values."},
+            {"role": "user", "content": prompt}
+        ]
+    
+    def _generate_title(self, theme, tokens=None):
+        """Generate a short title for a story about the given theme"""
+        title_prompt = f"Create a short, appealing title (maximum 6 words) for this bedtime story about {theme}:"
+        
+        title_response = self._complete(
+            'title',
+            tokens=tokens,
+            model="gpt-3.5-turbo",
+            messages=[
+                {"role": "system", "content": "You create short, child-friendly story titles."},
+                {"role": "user", "content": title_prompt}
+            ],
+            max_tokens=20,
+            temperature=0.5
+        )
+        
+        return title_response.choices[0].message.content.strip().strip('"')
+    
+    def _error_result(self, error):
+        """Map an OpenAI failure to a user-facing error result"""
+        error_message = str(error)
+        if "api_key" in error_message.lower():
             return {
-                'title': title,
-                'content': story_content,
-                'success': True
+                'title': 'API Configuration Error',
+                'content': 'There seems to be an issue with the OpenAI API key configuration. Please check that your API key is valid and has sufficient credits.',
+                'success': False
+            }
+        elif "quota" in error_message.lower() or "billing" in error_message.lower():
+            return {
+                'title': 'API Quota Exceeded',
+                'content': 'The OpenAI API quota has been exceeded. Please check your billing settings and try again later.',
+                'success': False
+            }
+        else:
+            return {
+                'title': 'Story Generation Error',
+                'content': f'Sorry, there was an error generating your story. Please try again in a moment. If the problem persists, the app will work in demo mode.',
+                'success': False
             }
-            
-        except Exception as e:
-            error_message = str(e)
-            if "api_key" in error_message.lower():
-                return {
-                    'title': 'API Configuration Error',
-                    'content': 'There seems to be an issue with the OpenAI API key configuration. Please check that your API key is valid and has sufficient credits.',
-                    'success': False
-                }
-            elif "quota" in error_message.lower() or "billing" in error_message.lower():
-                return {
-                    'title': 'API Quota Exceeded',
-                    'content': 'The OpenAI API quota has been exceeded. Please check your billing settings and try again later.',
-                    'success': False
-                }
-            else:
-                return {
-                    'title': 'Story Generation Error',
-                    'content': f'Sorry, there was an error generating your story. Please try again in a moment. If the problem persists, the app will work in demo mode.',
-                    'success': False
-                }
+    
+    @staticmethod
+    def _chunk_text(text, words_per_chunk=4):
+        """Split text into small word groups, keeping the original whitespace"""
+        tokens = re.findall(r'\S+\s*', text)
+        for i in range(0, len(tokens), words_per_chunk):
+            yield ''.join(tokens[i:i + words_per_chunk])
     
     def _generate_demo_story(self, theme, age_group, child_name=None, story_length='medium'):
         """Generate a demo story when OpenAI API is not available"""
-        child_name = child_name or "Alex"
-        
-        demo_stories = {
-            'brave princess': {
-                'title': f'{child_name} and the Crystal Castle',
-                'content': f"""Once upon a time, in a land filled with shimmering rainbows and gentle clouds, there lived a brave little person named {child_name}. {child_name} had always dreamed of visiting the magical Crystal Castle that sparkled on top of the highest hill.
-
-One sunny morning, {child_name} decided it was time for an adventure. With a small backpack filled with snacks and a heart full of courage, {child_name} began the journey up the winding path.
-
-Along the way, {child_name} met a lost baby rabbit who was crying softly. "Don't worry, little friend," said {child_name} kindly. "I'll help you find your family." Together, they searched until they found the rabbit's cozy burrow.
-
-The grateful rabbit's mother gave {child_name} a special crystal that glowed with warm, golden light. "This will guide you safely," she said with a smile.
+        story = demo_library().story(theme, age_group, child_name, story_length)
+        return dict(story, success=True, demo=True)
 
-When {child_name} finally reached the Crystal Castle, the doors opened wide to reveal a beautiful garden filled with flowers that sang gentle lullabies. The castle's wise guardian appeared and said, "Your kindness to the little rabbit has shown your true bravery. Welcome to our peaceful kingdom."
-
-{child_name} spent the day playing with friendly crystal butterflies and listening to the flowers' soothing songs. As the sun began to set, painting the sky in soft pastels, {child_name} knew it was time to go home.
-
-The journey back was quick and easy, guided by the magical crystal's warm glow. {child_name} arrived home just as the first stars appeared, feeling proud of the day's adventure and the new friendship made along the way.
-
-That night, {child_name} fell asleep peacefully, dreaming of crystal butterflies and gentle lullabies, knowing that tomorrow would bring new adventures and chances to help others."""
-            },
-            'space adventure': {
-                'title': f'{child_name} and the Sleepy Stars',
-                'content': f"""High above the clouds, where the stars twinkle like diamonds, lived a young space explorer named {child_name}. {child_name} had a special rocket ship painted in soft blues and silvers that could fly among the stars.
-
-One peaceful evening, {child_name} noticed that some stars seemed dimmer than usual. "I wonder if they're feeling sleepy," thought {child_name}. With a gentle whoosh, the rocket ship lifted off into the velvet night sky.
-
-As {child_name} flew closer to the stars, they discovered that the stars were indeed very tired. "We've been shining all day and all night," yawned a particularly drowsy star. "We need someone to sing us a lullaby."
-
-{child_name} had the perfect idea. From the rocket ship's special music box, {child_name} played the most beautiful, gentle melody that floated through space like silver ribbons. One by one, the tired stars began to smile and shine more brightly.
-
-The moon, who had been watching with delight, gave {child_name} a gift – a small bottle of moonbeam dust that sparkled like glitter. "Sprinkle this wherever you go," said the moon kindly, "and it will bring peaceful dreams."
-
-{child_name} flew home slowly, sprinkling the magical moonbeam dust over all the houses below. Children everywhere began to have the most wonderful, peaceful dreams filled with gentle starlight and soft lullabies.
-
-Back on Earth, {child_name} parked the rocket ship safely in the backyard and climbed into bed. The friendly stars winked goodnight through the window, and {child_name} drifted off to sleep, surrounded by the gentle glow of moonbeam dust and the quiet songs of happy stars."""
-            },
-            'friendly dragon': {
-                'title': f'{child_name} and the Rainbow Dragon',
-                'content': f"""In a valley surrounded by rolling green hills, there lived a gentle dragon named Rainbow who had scales that shimmered with every color imaginable. Unlike the scary dragons in old stories, Rainbow was kind and loved making friends with children.
-
-One day, a curious child named {child_name} was exploring the hills when they heard a soft, musical humming. Following the sound, {child_name} discovered Rainbow sitting by a peaceful pond, carefully tending to a garden of the most beautiful flowers anyone had ever seen.
-
-"Hello there," said Rainbow with a warm smile. "I'm Rainbow, and I take care of this magical garden. Each flower here represents a different dream that children have at night."
-
-{child_name} was amazed to see flowers that glowed like stars, petals that sparkled like jewels, and blooms that seemed to dance in the gentle breeze. "They're beautiful!" {child_name} exclaimed.
-
-Rainbow explained that every night, the dragon would collect the sweetest dreams from the flowers and blow them gently into the wind, so they could find their way to sleeping children all around the world.
-
-"Would you like to help me tonight?" asked Rainbow. {child_name} nodded eagerly, and together they carefully gathered the dream-essence from each flower. Rainbow showed {child_name} how to whisper kind wishes into the magical mist.
-
-As the evening stars appeared, Rainbow gently breathed the collected dreams into the night sky, where they transformed into twinkling lights that danced toward distant homes. {child_name} watched in wonder as the dreams floated away like gentle fireflies.
-
-"Thank you for helping me," said Rainbow. "Because of your kindness, children everywhere will have especially sweet dreams tonight." Rainbow gave {child_name} a small, glowing flower to take home as a reminder of their magical friendship.
+# Initialize story generator
+def _top_theme_names():
+    rows = db.session.query(Theme.name).order_by(Theme.popularity_score.desc()).limit(WARM_POOL_THEMES)
+    return [name for name, in rows]
 
-That night, {child_name} placed the special flower by the window and fell asleep with the biggest smile, knowing that somewhere in the hills, Rainbow was making sure everyone had wonderful dreams."""
-            },
-            'magical forest': {
-                'title': f'{child_name} and the Whispering Trees',
-                'content': f"""Deep in an enchanted forest where sunbeams danced through emerald leaves, there stood trees that could whisper the most wonderful secrets. A curious child named {child_name} discovered this magical place while following a pathway of golden leaves.
+warm_pool = create_pool(
+    app,
+    lambda *args: story_generator.generate_story(*args, fresh=True),
+    _top_theme_names,
+    path=WARM_POOL_PATH,
+    size=WARM_POOL_SIZE,
+    max_per_key=WARM_POOL_MAX_PER_KEY,
+    budget_per_hour=WARM_POOL_BUDGET,
+    interval=WARM_POOL_INTERVAL,
+    window=WARM_POOL_WINDOW,
+    max_live=WARM_POOL_MAX_LIVE,
+    max_age=WARM_POOL_MAX_AGE
+)
 
-As {child_name} walked deeper into the forest, the trees began to whisper gentle greetings. "Welcome, young friend," rustled the wise old oak. "We've been waiting for someone with a kind heart like yours."
+story_generator = StoryGenerator(
+    cache=create_cache(
+        STORY_CACHE,
+        path=STORY_CACHE_PATH,
+        variants=STORY_CACHE_VARIANTS,
+        ttl=STORY_CACHE_TTL,
+        max_keys=STORY_CACHE_MAX_KEYS
+    ),
+    limiter=RateLimiter(rpm=OPENAI_RPM, tpm=OPENAI_TPM, path=RATE_LIMIT_PATH, max_wait=OPENAI_MAX_WAIT),
+    breaker=CircuitBreaker(failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_seconds=CIRCUIT_RESET_SECONDS),
+    pool=warm_pool if WARM_POOL_SIZE > 0 and not DEMO_MODE else None
+)
 
-The trees explained that they were the guardians of all the forest creatures, and they needed {child_name}'s help. The woodland animals were preparing for their annual Festival of Friendship, but they had lost their way to the celebration clearing.
+# PDF Generation Service
+pdf_cache = PdfCache(max_bytes=PDF_CACHE_MAX_BYTES, directory=PDF_CACHE_DIR)
 
-{child_name} eagerly agreed to help. Following the whispered directions from the trees, {child_name} found a family of lost hedgehogs, guided a confused owl back to his tree, and helped a shy deer find her courage to join the celebration.
+def story_pdf_bytes(story):
+    """Return the rendered PDF for a story, reusing a cached copy when unchanged"""
+    version = story_version(story)
+    data = pdf_cache.get(story.id, version)
+    if data is None:
+        with metrics.timed('pdf_render_duration_seconds', timing='pdf', kind='story'):
+            data = render_story_pdf(story)
+        pdf_cache.put(story.id, version, data)
+    return data
 
-As the sun began to set, {child_name} arrived at a beautiful clearing where animals of all kinds had gathered. There were rabbits with flower crowns, squirrels sharing acorns, and butterflies creating colorful patterns in the air.
+def _timed_book(stories):
+    """Stream a bound PDF, timing the render that happens before the first chunk"""
+    chunks = stream_book(stories)
+    with metrics.timed('pdf_render_duration_seconds', kind='book'):
+        first = next(chunks, b'')
+    yield first
+    yield from chunks
 
-The animals cheered when they saw {child_name} and invited their new friend to join the celebration. They danced under the starlight, shared stories, and the trees provided the most beautiful music by rustling their leaves in harmony.
+def generate_pdf(story):
+    """Generate PDF for a story"""
+    return io.BytesIO(story_pdf_bytes(story))
 
-As a thank-you gift, the animals presented {child_name} with a special acorn that would always glow softly, serving as a reminder that kindness and helping others creates the most magical adventures.
+# HTTP caching
+@lru_cache(maxsize=None)
+def template_fingerprint(name):
+    """Short hash of a template and the base layout, so a deploy that changes them changes ETags"""
+    digest = hashlib.sha1()
+    for template in (name, 'base.html'):
+        source, _, _ = app.jinja_env.loader.get_source(app.jinja_env, template)
+        digest.update(source.encode('utf-8'))
+    return digest.hexdigest()[:8]
 
-When it was time to go home, the trees whispered directions for the safest path, and fireflies lit the way. {child_name} arrived home feeling grateful for the new friends and the magical day in the whispering forest.
+def story_validators(story_id):
+    """(revision, last modified) for a story without loading its text; 404 if it doesn't exist.
+    
+    The revision includes the creation time as well as the version, because SQLite hands a
+    deleted story's id to the next story and the new one must not match the old one's ETag.
+    """
+    row = db.session.query(Story.version, Story.updated_date, Story.created_date).filter(
+        Story.id == story_id
+    ).first()
+    if row is None:
+        abort(404)
+    created = row.created_date.strftime('%Y%m%d%H%M%S%f') if row.created_date else '0'
+    return f'{story_id}-{created}-v{row.version or 1}', row.updated_date or row.created_date
 
-That night, {child_name} held the glowing acorn close and fell asleep to the gentle memory of the trees' whispered songs, dreaming of more adventures with forest friends."""
-            }
-        }
-        
-        # Use a matching story or default
-        story_key = None
-        for key in demo_stories.keys():
-            if key.lower() in theme.lower() or theme.lower() in key.lower():
-                story_key = key
-                break
-        
-        if not story_key:
-            # Use first story as default but customize it
-            story_key = 'magical forest'
-            story = demo_stories[story_key]
-            # Customize title for the specific theme
-            story['title'] = f"{child_name} and the {theme.title()} Adventure"
-        else:
-            story = demo_stories[story_key]
-        
-        return {
-            'title': story['title'],
-            'content': story['content'],
-            'success': True,
-            'demo': True
-        }
+def story_cache_control():
+    if STORY_MAX_AGE > 0:
+        return f'public, max-age={STORY_MAX_AGE}'
+    return 'public, no-cache'
 
-# Initialize story generator
-story_generator = StoryGenerator()
+def conditional_response(etag, last_modified, cache_control, render):
+    """Answer with 304 if the client's copy is current, otherwise call ``render`` for the response.
 
-# PDF Generation Service
-def generate_pdf(story):
-    """Generate PDF for a story"""
-    buffer = io.BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=letter, topMargin=1*inch, bottomMargin=1*inch)
-    
-    styles = getSampleStyleSheet()
-    title_style = ParagraphStyle(
-        'CustomTitle',
-        parent=styles['Heading1'],
-        fontSize=18,
-        spaceAfter=30,
-        alignment=1  # Center alignment
-    )
-    
-    content_style = ParagraphStyle(
-        'CustomContent',
-        parent=styles['Normal'],
-        fontSize=12,
-        lineHeight=14,
-        spaceAfter=12
-    )
-    
-    story_elements = []
-    
-    # Add title
-    title = Paragraph(story.title, title_style)
-    story_elements.append(title)
-    story_elements.append(Spacer(1, 20))
-    
-    # Add story content with proper paragraph breaks
-    paragraphs = story.content.split('\n\n')
-    for paragraph in paragraphs:
-        if paragraph.strip():
-            p = Paragraph(paragraph.strip(), content_style)
-            story_elements.append(p)
-            story_elements.append(Spacer(1, 12))
-    
-    # Add metadata
-    story_elements.append(Spacer(1, 30))
-    metadata_style = ParagraphStyle(
-        'Metadata',
-        parent=styles['Normal'],
-        fontSize=10,
-        textColor='gray'
-    )
-    
-    metadata = f"Generated on: {story.created_date.strftime('%B %d, %Y')}<br/>Theme: {story.theme}<br/>Age Group: {story.age_group}"
-    if story.child_name:
-        metadata += f"<br/>Created for: {story.child_name}"
-    
-    story_elements.append(Paragraph(metadata, metadata_style))
-    
-    doc.build(story_elements)
-    buffer.seek(0)
-    return buffer
+    Either way the response carries the validators and Cache-Control.
+    """
+    if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = make_response(render())
+    else:
+        response = Response(status=304)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers['Cache-Control'] = cache_control
+    return response
 
 # Routes
 @app.route('/')
 def index():
     """Home page with story generation form"""
-    recent_stories = Story.query.order_by(Story.created_date.desc()).limit(5).all()
+    recent_stories = listing_query().order_by(Story.created_date.desc()).limit(5).all()
     popular_themes = Theme.query.order_by(Theme.popularity_score.desc()).limit(10).all()
     return render_template('index.html', 
                          recent_stories=recent_stories, 
                          popular_themes=popular_themes,
-                         demo_mode=DEMO_MODE)
+                         demo_mode=DEMO_MODE,
+                         generation_async=GENERATION_ASYNC)
 
 # Make demo_mode available to all templates
 @app.context_processor
@@ -342,89 +1062,442 @@ def api_status():
     """API endpoint to check demo mode status"""
     return jsonify({
         'demo_mode': DEMO_MODE,
-        'openai_configured': not DEMO_MODE
+        'openai_configured': not DEMO_MODE,
+        'generation': {
+            'mode': GENERATION_MODE,
+            'latency': story_generator.generation_stats()
+        },
+        'cache': story_generator.cache.stats() if story_generator.cache else None,
+        'warm_pool': story_generator.pool.stats() if story_generator.pool else None,
+        'compression': compressor.stats() if COMPRESSION else None,
+        'db_profile': query_profiler.stats() if DB_PROFILE else None,
+        'openai': {
+            'circuit': story_generator.breaker.stats(),
+            'rate_limit': story_generator.limiter.stats()
+        },
+        'jobs': dict(job_queue.stats(), enabled=GENERATION_ASYNC),
+        'theme_counts_pending': theme_counter.pending(),
+        'startup': startup,
+        'metrics': metrics.summary()
     })
 
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus scrape endpoint, summed over all workers when METRICS_DIR is set"""
+    return Response(metrics.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+def _story_json(story):
+    """Serialize a saved story for JSON responses"""
+    return {
+        'id': story.id,
+        'title': story.title,
+        'content': story.content,
+        'theme': story.theme,
+        'age_group': story.age_group,
+        'child_name': story.child_name,
+        'created_date': story.created_date.strftime('%B %d, %Y at %I:%M %p')
+    }
+
+def _read_generation_request():
+    """Read generation parameters from JSON, form data or the query string"""
+    if request.is_json:
+        data = request.get_json()
+    elif request.method == 'GET':
+        data = request.args
+    else:
+        data = request.form
+    
+    return _generation_params(data)
+
+def _generation_params(data):
+    """Normalize one set of generation parameters"""
+    return {
+        'theme': str(data.get('theme') or '').strip(),
+        'age_group': str(data.get('age_group') or '6'),
+        'child_name': str(data.get('child_name') or '').strip(),
+        'story_length': data.get('story_length') or 'medium'
+    }
+
+theme_counter = ThemeCounter(app, db, Theme, flush_interval=THEME_COUNT_FLUSH_SECONDS)
+
+def _new_story(result, theme, age_group, child_name, story_length):
+    """A Story for a generation result, with the tokens and time it took"""
+    generation_ms = result.get('generation_ms')
+    return Story(
+        title=result['title'],
+        content=result['content'],
+        theme=theme,
+        age_group=age_group,
+        child_name=child_name if child_name else None,
+        story_length=story_length,
+        prompt_tokens=result.get('prompt_tokens'),
+        completion_tokens=result.get('completion_tokens'),
+        generation_ms=round(generation_ms) if generation_ms is not None else None
+    )
+
+def _save_story(result, theme, age_group, child_name, story_length):
+    """Persist a generated story and update theme popularity"""
+    story = _new_story(result, theme, age_group, child_name, story_length)
+    db.session.add(story)
+    
+    # Update theme popularity
+    theme_counter.record(theme)
+    
+    db.session.commit()
+    return story
+
+def _run_story_job(job):
+    """Generate and save the story for a queued job"""
+    result = story_generator.generate_story(job.theme, job.age_group, job.child_name, job.story_length)
+    
+    if result['success']:
+        story = _save_story(result, job.theme, job.age_group, job.child_name, job.story_length)
+        job.story_id = story.id
+        job.status = 'done'
+    else:
+        job.error = result['content']
+        job.status = 'failed'
+
+job_queue = JobQueue(
+    app, db, StoryJob, _run_story_job,
+    workers=JOB_WORKERS,
+    poll_interval=JOB_POLL_INTERVAL,
+    lease_seconds=JOB_LEASE_SECONDS,
+    retention_seconds=JOB_RETENTION_SECONDS
+)
+
+def start_background_workers():
+    """Pick up queued jobs, including ones left behind by a restarted worker, and keep the warm pool topped up.
+    
+    Gunicorn calls this as each worker boots (see gunicorn.conf.py); requests also call it,
+    for servers without that hook. Starting is idempotent.
+    """
+    if GENERATION_ASYNC:
+        job_queue.start()
+    if story_generator.pool is not None:
+        story_generator.pool.start()
+
+app.before_request(start_background_workers)
+
+def _sse(event, data):
+    """Format a server-sent event frame"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
 @app.route('/generate', methods=['POST'])
 def generate_story():
     """Generate a new story"""
     try:
-        data = request.get_json() if request.is_json else request.form
-        
-        theme = data.get('theme', '').strip()
-        age_group = data.get('age_group', '6')
-        child_name = data.get('child_name', '').strip()
-        story_length = data.get('story_length', 'medium')
+        params = _read_generation_request()
         
-        if not theme:
+        if not params['theme']:
             return jsonify({'error': 'Theme is required'}), 400
         
+        if GENERATION_ASYNC or request.args.get('async') == '1':
+            job = job_queue.enqueue(**params)
+            return jsonify({
+                'success': True,
+                'job_id': job.id,
+                'status': job.status,
+                'status_url': url_for('get_job', job_id=job.id)
+            }), 202
+        
         # Generate the story
-        result = story_generator.generate_story(theme, age_group, child_name, story_length)
+        result = story_generator.generate_story(**params)
         
         if result['success']:
-            # Save to database
-            story = Story(
-                title=result['title'],
-                content=result['content'],
-                theme=theme,
-                age_group=age_group,
-                child_name=child_name if child_name else None,
-                story_length=story_length
-            )
-            db.session.add(story)
-            
-            # Update theme popularity
-            existing_theme = Theme.query.filter_by(name=theme.lower()).first()
-            if existing_theme:
-                existing_theme.popularity_score += 1
-            else:
-                new_theme = Theme(
-                    name=theme.lower(),
-                    description=f"Stories about {theme}",
-                    category="user_generated",
-                    popularity_score=1
-                )
-                db.session.add(new_theme)
-            
-            db.session.commit()
+            story = _save_story(result, **params)
             
             return jsonify({
                 'success': True,
                 'demo': result.get('demo', False),
-                'story': {
-                    'id': story.id,
-                    'title': story.title,
-                    'content': story.content,
-                    'theme': story.theme,
-                    'age_group': story.age_group,
-                    'child_name': story.child_name,
-                    'created_date': story.created_date.strftime('%B %d, %Y at %I:%M %p')
-                }
+                'degraded': result.get('degraded', False),
+                'story': _story_json(story)
             })
         else:
             return jsonify({'error': result['content']}), 500
             
     except Exception as e:
+        app.logger.exception('Story generation request failed')
+        return jsonify({'error': f'Server error: {str(e)}'}), 500
+
+@app.route('/generate/stream', methods=['GET', 'POST'])
+def generate_story_stream():
+    """Generate a new story, streaming the text as server-sent events"""
+    params = _read_generation_request()
+    
+    if not params['theme']:
+        return jsonify({'error': 'Theme is required'}), 400
+    
+    def events():
+        try:
+            for event in story_generator.stream_story(**params):
+                if event['type'] == 'chunk':
+                    yield _sse('chunk', {'text': event['text']})
+                elif event['success']:
+                    story = _save_story(event, **params)
+                    yield _sse('done', {
+                        'success': True,
+                        'demo': event.get('demo', False),
+                        'degraded': event.get('degraded', False),
+                        'story': _story_json(story)
+                    })
+                else:
+                    yield _sse('error', {'error': event['content']})
+        except Exception as e:
+            db.session.rollback()
+            yield _sse('error', {'error': f'Server error: {str(e)}'})
+    
+    return Response(
+        stream_with_context(events()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+def _batch_error(index, error):
+    return {'index': index, 'success': False, 'error': error}
+
+def _validate_batch(specs):
+    """Split batch items into (results, pending); invalid items get their error result in place"""
+    results = [None] * len(specs)
+    pending = []
+    for index, spec in enumerate(specs):
+        if not isinstance(spec, dict):
+            results[index] = _batch_error(index, 'Each story must be an object')
+            continue
+        params = _generation_params(spec)
+        if not params['theme']:
+            results[index] = _batch_error(index, 'Theme is required')
+        elif params['story_length'] not in story_generator.length_configs:
+            results[index] = _batch_error(index, 'Unknown story length')
+        else:
+            pending.append((index, params))
+    return results, pending
+
+def _generate_batch(pending, results):
+    """Generate the pending items concurrently; returns (index, params, result) for the successes.
+    
+    A failure, including an exception, is recorded in ``results`` for its own item only.
+    """
+    generated = []
+    workers = max(1, min(BATCH_CONCURRENCY, len(pending)))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='story-batch') as executor:
+        futures = [
+            (index, params, executor.submit(story_generator.generate_story, **params))
+            for index, params in pending
+        ]
+        for index, params, future in futures:
+            try:
+                result = future.result()
+            except Exception as e:
+                app.logger.exception('Batch story %d failed', index)
+                results[index] = _batch_error(index, f'Server error: {str(e)}')
+                continue
+            if result['success']:
+                generated.append((index, params, result))
+            else:
+                results[index] = _batch_error(index, result['content'])
+    return generated
+
+def _save_batch(generated):
+    """Save the generated stories and their theme counts in one transaction"""
+    stories = [_new_story(result, **params) for _, params, result in generated]
+    if stories:
+        db.session.add_all(stories)
+        theme_counter.record_many(Counter(params['theme'] for _, params, _ in generated))
+        db.session.commit()
+    return stories
+
+@app.route('/api/generate/batch', methods=['POST'])
+def generate_batch():
+    """Generate several stories concurrently and save them in one transaction"""
+    data = request.get_json(silent=True)
+    specs = data.get('stories') if isinstance(data, dict) else data
+    if not isinstance(specs, list) or not specs:
+        return jsonify({'error': 'Send a JSON list of stories, or {"stories": [...]}'}), 400
+    if len(specs) > BATCH_MAX_STORIES:
+        return jsonify({'error': f'At most {BATCH_MAX_STORIES} stories can be generated at once'}), 400
+    
+    # Invalid and failed items are reported in place instead of failing the batch
+    results, pending = _validate_batch(specs)
+    generated = _generate_batch(pending, results) if pending else []
+    try:
+        stories = _save_batch(generated)
+    except Exception as e:
+        db.session.rollback()
+        app.logger.exception('Saving a story batch failed')
         return jsonify({'error': f'Server error: {str(e)}'}), 500
+    
+    for (index, _, result), story in zip(generated, stories):
+        results[index] = {
+            'index': index,
+            'success': True,
+            'demo': result.get('demo', False),
+            'degraded': result.get('degraded', False),
+            'story': _story_json(story)
+        }
+    
+    return jsonify({
+        'success': bool(stories),
+        'generated': len(stories),
+        'failed': len(specs) - len(stories),
+        'results': results
+    })
+
+@app.route('/api/jobs/<job_id>')
+def get_job(job_id):
+    """API endpoint to poll a queued generation job"""
+    job = db.session.get(StoryJob, job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    data = {
+        'id': job.id,
+        'status': job.status,
+        'created_date': job.created_date.isoformat(),
+        'wait_seconds': round(((job.started_date or datetime.utcnow()) - job.created_date).total_seconds(), 2)
+    }
+    if job.status == 'done':
+        story = db.session.get(Story, job.story_id)
+        data['success'] = True
+        data['story'] = _story_json(story) if story else None
+    elif job.status == 'failed':
+        data['success'] = False
+        data['error'] = job.error
+    
+    return jsonify(data)
+
+@app.route('/api/jobs')
+def job_stats():
+    """API endpoint for queue depth and wait times"""
+    return jsonify(job_queue.stats())
+
+class KeysetPage:
+    """One page of newest-first stories, continued with an opaque cursor"""
+    
+    def __init__(self, items, next_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.has_next = next_cursor is not None
+
+def _encode_cursor(story):
+    raw = f"{story.created_date.isoformat()}|{story.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def _decode_cursor(cursor):
+    """Return (created_date, id) from a cursor, or None if it is malformed"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created, story_id = raw.rsplit('|', 1)
+        return datetime.fromisoformat(created), int(story_id)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+def _keyset_page(query, limit, cursor=None):
+    """Fetch the stories after ``cursor`` using the (created_date, id) index"""
+    if cursor:
+        position = _decode_cursor(cursor)
+        if position is None:
+            return None
+        query = query.filter(tuple_(Story.created_date, Story.id) < position)
+    
+    rows = query.order_by(Story.created_date.desc(), Story.id.desc()).limit(limit + 1).all()
+    next_cursor = _encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return KeysetPage(rows[:limit], next_cursor)
+
+def approximate_story_count():
+    """Cheap estimate of the number of stories, without a COUNT(*) scan"""
+    if db.engine.dialect.name == 'postgresql':
+        estimate = db.session.execute(
+            sa_text("SELECT reltuples::bigint FROM pg_class WHERE relname = 'story'")
+        ).scalar()
+        if estimate is not None and estimate >= 0:
+            return estimate
+    # Highest id is an upper bound that ignores deleted stories
+    return db.session.query(db.func.max(Story.id)).scalar() or 0
 
 @app.route('/stories')
 def list_stories():
     """List all saved stories"""
     page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor')
     per_page = 10
     
-    stories = Story.query.order_by(Story.created_date.desc()).paginate(
-        page=page, per_page=per_page, error_out=False
-    )
+    if cursor or STORIES_PAGINATION == 'keyset':
+        stories = _keyset_page(listing_query(), per_page, cursor)
+        if stories is None:
+            return redirect(url_for('list_stories'))
+    else:
+        stories = listing_query().order_by(Story.created_date.desc()).paginate(
+            page=page, per_page=per_page, error_out=False
+        )
     
     return render_template('stories.html', stories=stories)
 
+@app.route('/api/stories')
+def api_list_stories():
+    """API endpoint to list stories newest first, paginated by cursor"""
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+    page = _keyset_page(listing_query(), limit, request.args.get('cursor'))
+    if page is None:
+        return jsonify({'error': 'Invalid cursor'}), 400
+    
+    data = {
+        'stories': [{
+            'id': story.id,
+            'title': story.title,
+            'theme': story.theme,
+            'age_group': story.age_group,
+            'child_name': story.child_name,
+            'story_length': story.story_length,
+            'summary': story.summary,
+            'word_count': story.word_count,
+            'reading_minutes': story.reading_minutes,
+            'created_date': story.created_date.isoformat()
+        } for story in page.items],
+        'next_cursor': page.next_cursor
+    }
+    if request.args.get('approx_total') == '1':
+        data['approx_total'] = approximate_story_count()
+    
+    return jsonify(data)
+
+@lru_cache(maxsize=None)
+def _search_backend():
+    """Search implementation for the configured database, detected once"""
+    with app.app_context():
+        return search_backend(db.engine)
+
+@app.route('/api/stories/search')
+def api_search_stories():
+    """API endpoint for ranked full-text search over saved stories"""
+    query = request.args.get('q', '').strip()
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 50)
+    
+    if not query:
+        return jsonify({'error': 'Search query is required'}), 400
+    
+    started = time.perf_counter()
+    results = search_stories(db.session, _search_backend(), query, limit)
+    for result in results:
+        if result['created_date'] is not None:
+            result['created_date'] = result['created_date'].isoformat()
+        result['url'] = url_for('view_story', story_id=result['id'])
+    
+    return jsonify({
+        'query': query,
+        'results': results,
+        'took_ms': round((time.perf_counter() - started) * 1000, 1)
+    })
+
 @app.route('/story/<int:story_id>')
 def view_story(story_id):
     """View a specific story"""
-    story = Story.query.get_or_404(story_id)
-    return render_template('story.html', story=story)
+    revision, last_modified = story_validators(story_id)
+    etag = f"story-{revision}-{template_fingerprint('story.html')}{'-demo' if DEMO_MODE else ''}"
+    return conditional_response(
+        etag, last_modified, story_cache_control(),
+        lambda: render_template('story.html', story=Story.query.get_or_404(story_id))
+    )
 
 @app.route('/story/<int:story_id>/edit', methods=['GET', 'POST'])
 def edit_story(story_id):
@@ -434,7 +1507,9 @@ def edit_story(story_id):
     if request.method == 'POST':
         story.title = request.form.get('title', story.title)
         story.user_notes = request.form.get('user_notes', '')
+        story.touch()
         db.session.commit()
+        pdf_cache.invalidate(story.id)
         return redirect(url_for('view_story', story_id=story.id))
     
     return render_template('edit_story.html', story=story)
@@ -445,40 +1520,214 @@ def delete_story(story_id):
     story = Story.query.get_or_404(story_id)
     db.session.delete(story)
     db.session.commit()
+    pdf_cache.invalidate(story_id)
     return redirect(url_for('list_stories'))
 
 @app.route('/story/<int:story_id>/pdf')
 def export_pdf(story_id):
     """Export story as PDF"""
-    story = Story.query.get_or_404(story_id)
-    pdf_buffer = generate_pdf(story)
+    revision, last_modified = story_validators(story_id)
     
-    filename = f"{story.title.replace(' ', '_')}.pdf"
+    def render():
+        story = Story.query.get_or_404(story_id)
+        return send_file(
+            generate_pdf(story),
+            mimetype='application/pdf',
+            as_attachment=True,
+            download_name=pdf_filename(story)
+        )
     
-    return send_file(
-        pdf_buffer,
-        mimetype='application/pdf',
-        as_attachment=True,
-        download_name=filename
+    return conditional_response(f'pdf-{revision}', last_modified, story_cache_control(), render)
+
+def set_attachment(response, filename):
+    """Mark a response as a download, the way send_file does for non-ASCII names.
+    
+    Latin-1 headers can't carry other characters, so clients that read
+    ``filename*`` get the UTF-8 name and the rest an ASCII approximation.
+    """
+    try:
+        filename.encode('ascii')
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', filename).encode('ascii', 'ignore').decode('ascii')
+        names = {'filename': simple, 'filename*': f"UTF-8''{quote(filename, safe='!#$&+^`|~')}"}
+    else:
+        names = {'filename': filename}
+    response.headers.set('Content-Disposition', 'attachment', **names)
+    return response
+
+@app.route('/stories/export', methods=['GET', 'POST'])
+def export_stories():
+    """Export selected stories, or all of a child's stories, as one PDF or a ZIP"""
+    data = request.form if request.method == 'POST' else request.args
+    export_format = data.get('format', 'pdf')
+    child_name = data.get('child_name', '').strip()
+    story_ids = [int(i) for i in ','.join(data.getlist('ids')).split(',') if i.strip().isdigit()]
+    
+    if export_format not in ('pdf', 'zip'):
+        return jsonify({'error': "Format must be 'pdf' or 'zip'"}), 400
+    if not story_ids and not child_name:
+        return jsonify({'error': 'Select stories or a child name to export'}), 400
+    
+    query = Story.query
+    if story_ids:
+        query = query.filter(Story.id.in_(story_ids))
+    if child_name:
+        query = query.filter(Story.child_name == child_name)
+    
+    if query.count() > PDF_EXPORT_MAX_STORIES:
+        return jsonify({'error': f'At most {PDF_EXPORT_MAX_STORIES} stories can be exported at once'}), 400
+    
+    stories = query.order_by(Story.created_date).yield_per(20)
+    # Anything but letters, digits, dots and dashes could break the header or the saved file's name
+    basename = SAFE_FILENAME_RE.sub('_', child_name) + '_stories' if child_name else 'stories'
+    
+    if export_format == 'zip':
+        body = stream_zip(stories, story_pdf_bytes)
+        mimetype = 'application/zip'
+    else:
+        body = _timed_book(stories)
+        mimetype = 'application/pdf'
+    
+    response = Response(stream_with_context(body), mimetype=mimetype)
+    return set_attachment(response, f'{basename}.{export_format}')
+
+@app.route('/api/stories/export')
+def export_library():
+    """Stream every story as NDJSON, gzip-compressed with ?gzip=1"""
+    compress = request.args.get('gzip', '').lower() in ('1', 'true', 'yes')
+    body = encode_chunks(export_lines(db.session, Story), compress=compress)
+    filename = 'stories.ndjson.gz' if compress else 'stories.ndjson'
+    
+    return Response(
+        stream_with_context(body),
+        mimetype='application/gzip' if compress else 'application/x-ndjson',
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'}
     )
 
 @app.route('/api/themes')
 def get_themes():
     """API endpoint to get popular themes"""
     themes = Theme.query.order_by(Theme.popularity_score.desc()).limit(20).all()
-    return jsonify([{
+    response = jsonify([{
         'name': theme.name,
         'description': theme.description,
         'category': theme.category,
         'popularity': theme.popularity_score
     } for theme in themes])
+    # Popularity drifts slowly, so browsers and CDNs may reuse the list briefly and then revalidate
+    response.headers['Cache-Control'] = (
+        f'public, max-age={THEMES_MAX_AGE}, s-maxage={THEMES_CDN_MAX_AGE}, stale-while-revalidate={THEMES_MAX_AGE}'
+    )
+    response.add_etag()
+    return response.make_conditional(request)
+
+USAGE_GROUPS = {
+    'day': lambda: db.func.date(Story.created_date),
+    'theme': lambda: db.func.lower(Story.theme),
+    'length': lambda: Story.story_length,
+    'age_group': lambda: Story.age_group
+}
+
+def _usage_cost(prompt_tokens, completion_tokens):
+    return round(
+        (prompt_tokens or 0) / 1000 * OPENAI_PROMPT_PRICE + (completion_tokens or 0) / 1000 * OPENAI_COMPLETION_PRICE,
+        4
+    )
+
+@app.route('/api/usage')
+def api_usage():
+    """Tokens, generation time and estimated OpenAI cost of saved stories"""
+    days = min(max(request.args.get('days', 30, type=int), 1), 366)
+    group_by = [name.strip() for name in request.args.get('group_by', 'day').split(',') if name.strip()]
+    unknown = [name for name in group_by if name not in USAGE_GROUPS]
+    if unknown:
+        return jsonify({'error': f"Unknown group_by {', '.join(unknown)}; use {', '.join(USAGE_GROUPS)}"}), 400
+    
+    keys = [USAGE_GROUPS[name]().label(name) for name in group_by]
+    totals = [
+        db.func.count(Story.id).label('stories'),
+        # Demo and cached stories have no completion of their own; pooled ones carry their refill's tokens
+        db.func.count(Story.completion_tokens).label('openai_stories'),
+        db.func.coalesce(db.func.sum(Story.prompt_tokens), 0).label('prompt_tokens'),
+        db.func.coalesce(db.func.sum(Story.completion_tokens), 0).label('completion_tokens'),
+        db.func.avg(Story.completion_tokens).label('avg_completion_tokens'),
+        db.func.avg(Story.generation_ms).label('avg_generation_ms')
+    ]
+    since = datetime.utcnow() - timedelta(days=days)
+    query = db.session.query(*keys, *totals).filter(Story.created_date >= since)
+    if keys:
+        query = query.group_by(*keys).order_by(*keys)
+    
+    def usage_row(row):
+        data = row._asdict()
+        for name in group_by:
+            if hasattr(data[name], 'isoformat'):
+                data[name] = data[name].isoformat()
+        for name in ('avg_completion_tokens', 'avg_generation_ms'):
+            if data[name] is not None:
+                data[name] = round(float(data[name]), 1)
+        data['cost_usd'] = _usage_cost(data['prompt_tokens'], data['completion_tokens'])
+        return data
+    
+    groups = [usage_row(row) for row in query]
+    summary = {
+        name: sum(group[name] for group in groups)
+        for name in ('stories', 'openai_stories', 'prompt_tokens', 'completion_tokens')
+    }
+    summary['cost_usd'] = _usage_cost(summary['prompt_tokens'], summary['completion_tokens'])
+    
+    return jsonify({
+        'days': days,
+        'group_by': group_by,
+        'prices_per_1k_tokens': {'prompt': OPENAI_PROMPT_PRICE, 'completion': OPENAI_COMPLETION_PRICE},
+        'groups': groups,
+        'totals': summary
+    })
 
 # Initialize database
+def _add_missing_columns(table):
+    """Add nullable columns that were introduced after the table was created"""
+    existing = {column['name'] for column in inspect(db.engine).get_columns(table.name)}
+    with db.engine.begin() as conn:
+        for column in table.columns:
+            if column.name not in existing:
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                conn.execute(sa_text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+
+def _backfill_story_summaries(batch_size=500):
+    """Compute derived fields for stories saved before they existed"""
+    while True:
+        stories = Story.query.filter(Story.summary.is_(None)).limit(batch_size).all()
+        if not stories:
+            break
+        for story in stories:
+            story.update_derived_fields()
+        db.session.commit()
+
+def _backfill_story_versions():
+    """Give stories saved before versioning a version and last-modified time"""
+    with db.engine.begin() as conn:
+        conn.execute(sa_text('UPDATE story SET version = 1 WHERE version IS NULL'))
+        conn.execute(sa_text('UPDATE story SET updated_date = created_date WHERE updated_date IS NULL'))
+
 def create_tables():
+    """Create or upgrade the schema and the search index"""
     with app.app_context():
         db.create_all()
         
-        # Add some default themes if none exist
+        # create_all skips tables that already exist, so add any columns and indexes they lack
+        for table in (Story.__table__, Theme.__table__):
+            _add_missing_columns(table)
+            for index in table.indexes:
+                index.create(db.engine, checkfirst=True)
+        
+        setup_search(db.engine)
+        _backfill_story_summaries()
+        _backfill_story_versions()
+
+def seed_themes():
+    """Add the default themes to an empty theme table; returns how many were added"""
+    with app.app_context():
         if Theme.query.count() == 0:
             default_themes = [
                 {'name': 'brave princess', 'category': 'fairy_tale', 'description': 'Stories about courageous princesses'},
@@ -496,10 +1745,93 @@ def create_tables():
                 db.session.add(theme)
             
             db.session.commit()
+            return len(default_themes)
+        return 0
+
+@app.cli.command('init-db')
+@click.option('--seed/--no-seed', default=True, help='Add the default themes to an empty database')
+def init_db_command(seed):
+    """Create or upgrade the database schema and seed the default themes"""
+    create_tables()
+    if seed:
+        click.echo(f'Added {seed_themes()} default themes')
+    click.echo('Database is ready')
+
+@app.cli.command('seed-themes')
+def seed_themes_command():
+    """Add the default themes if there are none yet"""
+    click.echo(f'Added {seed_themes()} default themes')
+
+@app.cli.command('export-stories')
+@click.argument('output', default='-')
+@click.option('--gzip/--no-gzip', 'compress', default=None, help='Compress the output (default: when OUTPUT ends in .gz)')
+@click.option('--batch-size', default=1000, show_default=True, help='Rows fetched from the database at a time')
+def export_stories_command(output, compress, batch_size):
+    """Write every story to OUTPUT as NDJSON ('-' for stdout)"""
+    if compress is None:
+        compress = output.endswith('.gz')
+    with app.app_context(), click.open_file(output, 'wb') as f:
+        lines = export_lines(db.session, Story, batch_size=batch_size)
+        for chunk in encode_chunks(lines, compress=compress):
+            f.write(chunk)
+    if output != '-':
+        click.echo(f'Exported stories to {output}')
+
+@app.cli.command('import-stories')
+@click.argument('source', default='-')
+@click.option('--batch-size', default=1000, show_default=True, help='Rows inserted per statement and commit')
+@click.option('--keep-ids', is_flag=True, help='Keep the exported story ids, e.g. when restoring into an empty database')
+def import_stories_command(source, batch_size, keep_ids):
+    """Load stories from an NDJSON export (plain or gzip), then recompute theme popularity"""
+    duplicates = 0
+    
+    def report(line_number, error):
+        nonlocal duplicates
+        duplicates += isinstance(error, DuplicateId)
+        click.echo(f'Skipping line {line_number}: {error}', err=True)
+    
+    def prepare(row):
+        row.update(derived_story_fields(row['content']))
+    
+    with app.app_context(), click.open_file(source, 'rb') as f:
+        imported, skipped = import_lines(
+            db.session, Story, open_lines(f), prepare=prepare,
+            batch_size=batch_size, keep_ids=keep_ids, on_error=report
+        )
+        themes = rebuild_theme_popularity(db.session, Theme, Story)
+        db.session.commit()
+    click.echo(f'Imported {imported} stories ({skipped} skipped); popularity rebuilt for {themes} themes')
+    if duplicates:
+        raise click.ClickException(f'{duplicates} stories were not imported because their ids are already taken')
+
+@app.cli.command('rebuild-popularity')
+def rebuild_popularity_command():
+    """Recompute theme popularity from the saved stories"""
+    with app.app_context():
+        themes = rebuild_theme_popularity(db.session, Theme, Story)
+        db.session.commit()
+    click.echo(f'Popularity rebuilt for {themes} themes')
+
+# Startup timing for this process: module import, and import until the first response
+startup = {'import_seconds': round(time.perf_counter() - IMPORT_STARTED, 3), 'first_request_seconds': None}
+_startup_lock = threading.Lock()
+metrics.observe('app_startup_seconds', startup['import_seconds'], phase='import')
 
-# Initialize the database
-create_tables()
+@app.after_request
+def record_first_request(response):
+    """Record how long this worker took to serve its first response"""
+    if startup['first_request_seconds'] is None:
+        with _startup_lock:
+            if startup['first_request_seconds'] is None:
+                elapsed = time.perf_counter() - IMPORT_STARTED
+                startup['first_request_seconds'] = round(elapsed, 3)
+                metrics.observe('app_startup_seconds', elapsed, phase='first_request')
+                app.logger.info('First response %.0f ms after import started', elapsed * 1000)
+    return response
 
 if __name__ == '__main__':
+    create_tables()
+    seed_themes()
+    start_background_workers()
     port = int(os.environ.get('PORT', 5000))
     app.run(debug=os.getenv('FLASK_ENV') == 'development', host='0.0.0.0', port=port)
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+"""
+Load-test the running app and report latency percentiles as JSON.
+
+Typical run against a local stack with the fake OpenAI server:
+
+    python fake_openai.py --latency 0.5 &
+    OPENAI_API_KEY=fake OPENAI_BASE_URL=http://127.0.0.1:8001/v1 \\
+        gunicorn --bind 127.0.0.1:5000 app:app &
+    python benchmark.py --seed 2000 --concurrency 16 --duration 30 --output run.json
+
+--seed inserts stories straight into the app's database, so run it with
+the same DATABASE_URL as the server. --compare prints the change against
+an earlier run's JSON.
+"""
+import argparse
+import http.client
+import json
+import math
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from urllib.parse import urlencode, urlsplit
+
+THEMES = ['space adventure', 'friendly dragon', 'magical forest', 'brave princess',
+          'underwater kingdom', 'talking toys', 'time travel', 'sleepy owl']
+NAMES = ['Mia', 'Leo', 'Ava', 'Noah', 'Zoe', 'Sam', '']
+LENGTHS = ['short', 'medium', 'long']
+
+
+def seed_database(count, batch_size=1000):
+    """Insert ``count`` demo stories directly into the app's database"""
+    import app as story_app
+    from sqlalchemy import insert
+
+    rng = random.Random(42)
+    library = story_app.demo_library()
+    with story_app.app.app_context():
+        story_app.create_tables()
+        for start in range(0, count, batch_size):
+            rows = []
+            for _ in range(min(batch_size, count - start)):
+                theme, name = rng.choice(THEMES), rng.choice(NAMES) or None
+                age_group, story_length = str(rng.randint(3, 12)), rng.choice(LENGTHS)
+                story = library.story(theme, age_group, name, story_length)
+                # Bulk inserts skip the ORM's before_insert hook, so derive the fields the same way it does
+                rows.append(dict(
+                    story_app.derived_story_fields(story['content']),
+                    title=story['title'],
+                    content=story['content'],
+                    theme=theme,
+                    age_group=age_group,
+                    child_name=name,
+                    story_length=story_length,
+                    created_date=datetime.utcnow()
+                ))
+            story_app.db.session.execute(insert(story_app.Story), rows)
+            story_app.db.session.commit()
+
+
+class Client:
+    """Keep-alive HTTP connection for one benchmark thread"""
+
+    def __init__(self, base_url, timeout):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == 'https' else 80)
+        self.https = parts.scheme == 'https'
+        self.timeout = timeout
+        self.conn = None
+
+    def request(self, method, path, body=None, headers=None):
+        """Return (status, body); the body is read in full"""
+        for attempt in range(2):
+            if self.conn is None:
+                factory = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+                self.conn = factory(self.host, self.port, timeout=self.timeout)
+            try:
+                self.conn.request(method, path, body=body, headers=headers or {})
+                response = self.conn.getresponse()
+                data = response.read()
+                if response.getheader('Connection', '').lower() == 'close':
+                    self.close()
+                return response.status, data
+            except (http.client.HTTPException, ConnectionError):
+                self.close()
+                if attempt:
+                    raise
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+def _generate_request(rng, ids):
+    body = urlencode({
+        'theme': rng.choice(THEMES),
+        'age_group': str(rng.randint(3, 12)),
+        'child_name': rng.choice(NAMES),
+        'story_length': rng.choice(LENGTHS)
+    })
+    return 'POST', '/generate', body, {'Content-Type': 'application/x-www-form-urlencoded'}
+
+
+SCENARIOS = {
+    'generate': _generate_request,
+    'stories': lambda rng, ids: ('GET', f'/stories?page={rng.randint(1, 5)}', None, None),
+    'story': lambda rng, ids: ('GET', f'/story/{rng.choice(ids)}', None, None),
+    'pdf': lambda rng, ids: ('GET', f'/story/{rng.choice(ids)}/pdf', None, None),
+    'themes': lambda rng, ids: ('GET', '/api/themes', None, None),
+}
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a sorted list"""
+    if not values:
+        return None
+    rank = max(1, math.ceil(pct / 100 * len(values)))
+    return values[rank - 1]
+
+
+def story_ids(base_url, timeout, limit=500):
+    """Ids of existing stories, for the story and pdf scenarios"""
+    client = Client(base_url, timeout)
+    ids = []
+    cursor = None
+    while len(ids) < limit:
+        path = '/api/stories?limit=100' + (f'&cursor={cursor}' if cursor else '')
+        status, data = client.request('GET', path)
+        if status != 200:
+            break
+        page = json.loads(data)
+        ids.extend(story['id'] for story in page['stories'])
+        cursor = page.get('next_cursor')
+        if not cursor:
+            break
+    client.close()
+    return ids
+
+
+def run_scenario(name, base_url, concurrency, duration, requests, timeout, ids):
+    """Drive one scenario and summarize its latencies"""
+    make_request = SCENARIOS[name]
+    latencies = []
+    statuses = {}
+    errors = []
+    lock = threading.Lock()
+    remaining = [requests]
+    deadline = time.perf_counter() + duration if duration else None
+
+    def worker(seed):
+        rng = random.Random(seed)
+        client = Client(base_url, timeout)
+        while True:
+            with lock:
+                if requests and remaining[0] <= 0:
+                    break
+                remaining[0] -= 1
+            if deadline and time.perf_counter() >= deadline:
+                break
+
+            method, path, body, headers = make_request(rng, ids)
+            started = time.perf_counter()
+            try:
+                status, _ = client.request(method, path, body, headers)
+            except Exception as e:
+                with lock:
+                    errors.append(type(e).__name__)
+                continue
+            elapsed = (time.perf_counter() - started) * 1000
+            with lock:
+                latencies.append(elapsed)
+                statuses[status] = statuses.get(status, 0) + 1
+        client.close()
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    ok = sum(count for status, count in statuses.items() if status < 400)
+    return {
+        'requests': len(latencies) + len(errors),
+        'ok': ok,
+        'status_counts': {str(k): v for k, v in sorted(statuses.items())},
+        'connection_errors': len(errors),
+        'duration_s': round(wall, 3),
+        'throughput_rps': round(len(latencies) / wall, 2) if wall else 0.0,
+        'latency_ms': {
+            'min': round(latencies[0], 2) if latencies else None,
+            'mean': round(sum(latencies) / len(latencies), 2) if latencies else None,
+            'p50': round(percentile(latencies, 50), 2) if latencies else None,
+            'p95': round(percentile(latencies, 95), 2) if latencies else None,
+            'p99': round(percentile(latencies, 99), 2) if latencies else None,
+            'max': round(latencies[-1], 2) if latencies else None,
+        }
+    }
+
+
+def _git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(previous, current):
+    """Print p95 latency and throughput changes between two runs"""
+    for name, result in current['scenarios'].items():
+        before = previous.get('scenarios', {}).get(name)
+        if not before or not before['latency_ms']['p95'] or not result['latency_ms']['p95']:
+            continue
+        p95_change = (result['latency_ms']['p95'] / before['latency_ms']['p95'] - 1) * 100
+        rps_change = ((result['throughput_rps'] / before['throughput_rps'] - 1) * 100
+                      if before['throughput_rps'] else 0.0)
+        print(f'{name:>9}: p95 {p95_change:+6.1f}%  throughput {rps_change:+6.1f}%', file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the bedtime story app')
+    parser.add_argument('--base-url', default='http://127.0.0.1:5000')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f'comma-separated subset of: {", ".join(SCENARIOS)}')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=15.0,
+                        help='seconds per scenario (ignored when --requests is set)')
+    parser.add_argument('--requests', type=int, default=0, help='requests per scenario')
+    parser.add_argument('--timeout', type=float, default=120.0, help='per-request timeout')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='insert this many stories into DATABASE_URL first')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    parser.add_argument('--compare', help='earlier JSON report to compare against')
+    args = parser.parse_args(argv)
+
+    names = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = set(names) - set(SCENARIOS)
+    if unknown:
+        parser.error(f'unknown scenarios: {", ".join(sorted(unknown))}')
+
+    if args.seed:
+        print(f'Seeding {args.seed} stories...', file=sys.stderr)
+        seed_database(args.seed)
+
+    ids = story_ids(args.base_url, args.timeout)
+    if not ids and {'story', 'pdf'} & set(names):
+        parser.error('the story and pdf scenarios need saved stories; use --seed')
+
+    duration = 0 if args.requests else args.duration
+    report = {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'git_revision': _git_revision(),
+        'python': platform.python_version(),
+        'base_url': args.base_url,
+        'concurrency': args.concurrency,
+        'duration_s': duration or None,
+        'requests_per_scenario': args.requests or None,
+        'scenarios': {}
+    }
+    for name in names:
+        print(f'Running {name}...', file=sys.stderr)
+        result = run_scenario(
+            name, args.base_url, args.concurrency, duration, args.requests, args.timeout, ids
+        )
+        report['scenarios'][name] = result
+        latency = result['latency_ms']
+        print(f"{name:>9}: {result['throughput_rps']:8.1f} req/s  p50 {latency['p50']} ms  "
+              f"p95 {latency['p95']} ms  p99 {latency['p99']} ms  ok {result['ok']}/{result['requests']}",
+              file=sys.stderr)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
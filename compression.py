@@ -0,0 +1,151 @@
+"""
+Response compression.
+
+Responses above a size threshold are compressed with brotli or gzip,
+whichever the client's Accept-Encoding prefers (brotli only when the
+``brotli`` package is installed). Streamed responses, such as server-sent
+events and exports, pass through untouched so they still flush chunk by
+chunk. Responses with an ETag are the ones that get requested again, so
+their compressed form is kept in an LRU cache keyed by a digest of the
+body, and reused instead of being compressed again on every hit. The key
+is the body itself rather than the ETag, so a stale or colliding ETag can
+never serve another response's bytes.
+"""
+import gzip
+import hashlib
+import threading
+from collections import Counter, OrderedDict
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # optional; gzip is always available
+    brotli = None
+
+COMPRESSIBLE_TYPES = (
+    'text/', 'application/json', 'application/javascript', 'application/xml',
+    'application/x-ndjson', 'image/svg+xml'
+)
+
+
+class Compressor:
+    """Compresses responses in an ``after_request`` hook"""
+
+    def __init__(self, min_size=1024, gzip_level=6, brotli_quality=5,
+                 cache_max_bytes=16 * 1024 * 1024, max_buffer=8 * 1024 * 1024):
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.cache_max_bytes = cache_max_bytes
+        self.max_buffer = max_buffer
+        self.encodings = ('br', 'gzip') if brotli is not None else ('gzip',)
+        self._cache = OrderedDict()
+        self._cache_size = 0
+        self._counters = Counter()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.after_request(self.compress_response)
+
+    def compress_response(self, response):
+        if response.status_code == 304:
+            # Caches must know a revalidated response could have come in another encoding
+            response.vary.add('Accept-Encoding')
+        if not self._compressible(response):
+            return response
+
+        response.vary.add('Accept-Encoding')
+        encoding = request.accept_encodings.best_match(self.encodings)
+        if encoding is None:
+            return response
+        data = self._body(response)
+        if data is None or len(data) < self.min_size:
+            return response
+
+        etag, _ = response.get_etag()
+        key = (hashlib.blake2b(data, digest_size=16).digest(), encoding) if etag else None
+        compressed = self._cached(key) if key else None
+        if compressed is None:
+            compressed = self._compress(data, encoding)
+            if key:
+                self._store(key, compressed)
+        if len(compressed) >= len(data):
+            return response
+
+        response.set_data(compressed)
+        response.headers['Content-Encoding'] = encoding
+        if etag:
+            # The encoded bytes differ from the identity representation, so the ETag can only be weak.
+            # Conditional requests compare weakly and still get a 304.
+            response.set_etag(etag, weak=True)
+        with self._lock:
+            self._counters['responses'] += 1
+            self._counters['bytes_in'] += len(data)
+            self._counters['bytes_out'] += len(compressed)
+        return response
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+            entries, size = len(self._cache), self._cache_size
+        bytes_in = counters.get('bytes_in', 0)
+        return {
+            'encodings': list(self.encodings),
+            'responses': counters.get('responses', 0),
+            'bytes_in': bytes_in,
+            'bytes_out': counters.get('bytes_out', 0),
+            'ratio': round(counters.get('bytes_out', 0) / bytes_in, 3) if bytes_in else None,
+            'cache': {
+                'hits': counters.get('cache_hits', 0),
+                'misses': counters.get('cache_misses', 0),
+                'entries': entries,
+                'bytes': size
+            }
+        }
+
+    def _compressible(self, response):
+        if response.status_code < 200 or response.status_code >= 300 or response.status_code in (204, 206):
+            return False
+        if 'Content-Encoding' in response.headers or response.cache_control.no_transform:
+            return False
+        return (response.mimetype or '').startswith(COMPRESSIBLE_TYPES)
+
+    def _body(self, response):
+        """The full body, or None for responses that must keep streaming"""
+        if response.direct_passthrough:
+            # send_file responses have a known size and can be buffered when it is modest
+            length = response.content_length
+            if length is None or length < self.min_size or length > self.max_buffer:
+                return None
+            response.direct_passthrough = False
+        elif response.is_streamed:
+            return None
+        return response.get_data()
+
+    def _compress(self, data, encoding):
+        if encoding == 'br':
+            return brotli.compress(data, quality=self.brotli_quality)
+        return gzip.compress(data, compresslevel=self.gzip_level, mtime=0)
+
+    def _cached(self, key):
+        with self._lock:
+            data = self._cache.get(key)
+            if data is None:
+                self._counters['cache_misses'] += 1
+                return None
+            self._cache.move_to_end(key)
+            self._counters['cache_hits'] += 1
+            return data
+
+    def _store(self, key, data):
+        if len(data) > self.cache_max_bytes:
+            return
+        with self._lock:
+            if key in self._cache:
+                return
+            self._cache[key] = data
+            self._cache_size += len(data)
+            while self._cache_size > self.cache_max_bytes:
+                _, evicted = self._cache.popitem(last=False)
+                self._cache_size -= len(evicted)
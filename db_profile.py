@@ -0,0 +1,136 @@
+"""
+Per-request database profiling, for development.
+
+Every request logs how many queries it issued and how long they took in
+total, and any single query slower than a threshold is logged with its
+SQL. Statements are reduced to their shape, with parameters and literals
+replaced by ``?``; one shape run many times in one request is the N+1
+pattern (a list page loading something per row) and is logged as a
+warning, naming the template when the queries ran while it rendered.
+Streamed responses are logged once their body has been sent.
+"""
+import logging
+import re
+import threading
+import time
+from collections import Counter
+
+from flask import before_render_template, g, has_request_context, request, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_PARAM = re.compile(r'%\(\w+\)s|%s|(?<![:\w]):\w+')
+_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+
+
+def statement_shape(statement):
+    """SQL with parameters, literals and IN lists collapsed, so repeats of one query compare equal"""
+    shape = _PARAM.sub('?', _LITERAL.sub('?', statement))
+    return ' '.join(_LIST.sub('(?)', shape).split())
+
+
+class QueryProfiler:
+    """Logs query count, database time, slow queries and repeated queries per request"""
+
+    def __init__(self, slow_query_ms=100, repeat_threshold=5):
+        self.slow_query = slow_query_ms / 1000
+        self.repeat_threshold = repeat_threshold
+        self._routes = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.before_request(self._start_request)
+        # Teardown runs after a streamed body is finished, so its queries are counted too
+        app.teardown_request(self._finish_request)
+        before_render_template.connect(self._start_render, app)
+        template_rendered.connect(self._finish_render, app)
+        event.listen(Engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', self._after_cursor_execute)
+        if not logger.handlers:
+            # Profiling output is meant to be seen without configuring logging first
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter('[db] %(levelname)s %(message)s'))
+            logger.addHandler(handler)
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+
+    def stats(self):
+        """Queries and database time per request for each route, busiest first"""
+        with self._lock:
+            routes = {route: dict(entry) for route, entry in self._routes.items()}
+        return {
+            route: {
+                'requests': entry['requests'],
+                'avg_queries': round(entry['queries'] / entry['requests'], 1),
+                'max_queries': entry['max_queries'],
+                'avg_db_ms': round(entry['seconds'] * 1000 / entry['requests'], 2),
+                'n_plus_one': entry['n_plus_one']
+            }
+            for route, entry in sorted(
+                routes.items(), key=lambda item: item[1]['queries'] / item[1]['requests'], reverse=True
+            )
+        }
+
+    def _start_request(self):
+        g.db_profile = {'queries': 0, 'seconds': 0.0, 'shapes': Counter(), 'template': None}
+
+    def _start_render(self, sender, template, context, **extra):
+        profile = g.get('db_profile')
+        if profile is not None:
+            profile['template'] = template.name or 'a template string'
+
+    def _finish_render(self, sender, template, context, **extra):
+        profile = g.get('db_profile')
+        if profile is not None:
+            profile['template'] = None
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('profile_query_start', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get('profile_query_start')
+        if not starts:
+            return
+        elapsed = time.perf_counter() - starts.pop()
+        profile = g.get('db_profile') if has_request_context() else None
+        if profile is None:
+            return
+
+        profile['queries'] += 1
+        profile['seconds'] += elapsed
+        profile['shapes'][(statement_shape(statement), profile['template'])] += 1
+        if elapsed >= self.slow_query:
+            logger.warning(
+                'Slow query in %s (%.1f ms): %s',
+                request.endpoint or 'unmatched', elapsed * 1000, ' '.join(statement.split())
+            )
+
+    def _finish_request(self, error=None):
+        profile = g.pop('db_profile', None)
+        if profile is None:
+            return
+
+        route = request.endpoint or 'unmatched'
+        logger.info(
+            '%s %s: %d queries, %.1f ms in the database',
+            request.method, request.path, profile['queries'], profile['seconds'] * 1000
+        )
+        repeated = False
+        for (shape, template), count in profile['shapes'].items():
+            if count >= self.repeat_threshold:
+                repeated = True
+                where = f' while rendering {template}' if template else ''
+                logger.warning('Possible N+1 in %s: one query ran %d times%s: %s', route, count, where, shape)
+
+        with self._lock:
+            entry = self._routes.setdefault(
+                route, {'requests': 0, 'queries': 0, 'seconds': 0.0, 'max_queries': 0, 'n_plus_one': 0}
+            )
+            entry['requests'] += 1
+            entry['queries'] += profile['queries']
+            entry['seconds'] += profile['seconds']
+            entry['max_queries'] = max(entry['max_queries'], profile['queries'])
+            entry['n_plus_one'] += repeated
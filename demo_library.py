@@ -0,0 +1,168 @@
+"""
+Demo story templates, served when OpenAI is not configured or unavailable.
+
+Each template is a text file with a short header, a blank line and the
+story:
+
+    title: {child_name} and the Crystal Castle
+    themes: brave princess, princess, castle, knight
+    default: yes
+
+    Once upon a time ...
+
+``{child_name}`` and ``{theme}`` are filled in per request. ``themes``
+lists the words and phrases a template answers to, and templates marked
+``default`` serve themes that match nothing.
+
+The directory is read once. Each template is split around its
+placeholders so rendering is a single join, and the theme words go into
+an inverted index from token to templates, so matching costs a few
+dictionary lookups however many templates there are. Among equally good
+matches a hash of the request picks the variant, so the same request
+always gets the same story.
+"""
+import os
+import re
+import threading
+import zlib
+from collections import Counter
+
+DEFAULT_NAME = 'Alex'
+FALLBACK_TITLE = '{child_name} and the {theme} Adventure'
+
+_FIELD = re.compile(r'\{(child_name|theme)\}')
+_WORD = re.compile(r'[a-z0-9]+')
+STOPWORDS = frozenset({
+    'a', 'an', 'and', 'the', 'of', 'in', 'on', 'at', 'to', 'for', 'with', 'about',
+    'my', 'who', 'story', 'stories', 'tale', 'adventure', 'adventures'
+})
+
+
+def tokens(text):
+    """Lowercase words with simple plurals folded and filler words dropped"""
+    result = []
+    for word in _WORD.findall(text.lower()):
+        if len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+            word = word[:-1]
+        if word not in STOPWORDS:
+            result.append(word)
+    return result
+
+
+class CompiledText:
+    """Text split into literal parts (even positions) and field names (odd positions)"""
+
+    __slots__ = ('parts', 'literals', 'only_field')
+
+    def __init__(self, text):
+        self.parts = _FIELD.split(text)
+        self.literals = self.parts[::2]
+        names = set(self.parts[1::2])
+        # Text with a single kind of placeholder renders as one str.join
+        self.only_field = names.pop() if len(names) == 1 else None
+
+    def render(self, fields):
+        if self.only_field is not None:
+            return fields[self.only_field].join(self.literals)
+        parts = self.parts
+        if len(parts) == 1:
+            return parts[0]
+        parts = parts[:]
+        for i in range(1, len(parts), 2):
+            parts[i] = fields[parts[i]]
+        return ''.join(parts)
+
+
+class DemoTemplate:
+    def __init__(self, name, title, content, themes, default=False):
+        self.name = name
+        self.title = CompiledText(title)
+        self.content = CompiledText(content)
+        self.themes = themes
+        self.default = default
+
+
+def parse_template(name, text):
+    """Build a template from the text of a template file"""
+    header, _, body = text.replace('\r\n', '\n').partition('\n\n')
+    fields = {}
+    for line in header.splitlines():
+        key, sep, value = line.partition(':')
+        if not sep:
+            raise ValueError(f'{name}: header line without a colon: {line!r}')
+        fields[key.strip().lower()] = value.strip()
+
+    if not fields.get('title') or not body.strip():
+        raise ValueError(f'{name}: a title and a story are required')
+    return DemoTemplate(
+        name,
+        fields['title'],
+        body.strip(),
+        [theme.strip() for theme in fields.get('themes', '').split(',') if theme.strip()],
+        default=fields.get('default', '').lower() in ('1', 'true', 'yes')
+    )
+
+
+class DemoLibrary:
+    """Indexed, precompiled demo templates"""
+
+    def __init__(self, templates, max_memo=10000):
+        if not templates:
+            raise ValueError('The demo story library is empty')
+        self.templates = templates
+        self.defaults = tuple(i for i, t in enumerate(templates) if t.default) or tuple(range(len(templates)))
+        self.fallback_title = CompiledText(FALLBACK_TITLE)
+        self.index = {}
+        for i, template in enumerate(templates):
+            for token in set(tokens(' '.join(template.themes))):
+                self.index.setdefault(token, []).append(i)
+        self.index = {token: tuple(ids) for token, ids in self.index.items()}
+        self.max_memo = max_memo
+        self._memo = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, directory):
+        """Read every ``*.txt`` template in ``directory``"""
+        templates = []
+        for filename in sorted(os.listdir(directory)):
+            if filename.endswith('.txt'):
+                with open(os.path.join(directory, filename), encoding='utf-8') as f:
+                    templates.append(parse_template(filename[:-4], f.read()))
+        return cls(templates)
+
+    def match(self, theme):
+        """(template indexes, matched) for a theme: the best keyword matches, or the defaults"""
+        key = theme.lower()
+        found = self._memo.get(key)
+        if found is not None:
+            return found
+
+        scores = Counter()
+        for token in set(tokens(theme)):
+            for i in self.index.get(token, ()):
+                scores[i] += 1
+        if scores:
+            best = max(scores.values())
+            found = (tuple(sorted(i for i, score in scores.items() if score == best)), True)
+        else:
+            found = (self.defaults, False)
+
+        with self._lock:
+            if len(self._memo) >= self.max_memo:
+                self._memo.clear()
+            self._memo[key] = found
+        return found
+
+    def story(self, theme, age_group='', child_name=None, story_length='medium'):
+        """Title and content for a request"""
+        candidates, matched = self.match(theme)
+        if len(candidates) == 1:
+            template = self.templates[candidates[0]]
+        else:
+            seed = f'{theme.lower()}|{age_group}|{child_name or ""}|{story_length}'.encode('utf-8')
+            template = self.templates[candidates[zlib.crc32(seed) % len(candidates)]]
+
+        fields = {'child_name': child_name or DEFAULT_NAME, 'theme': theme.title()}
+        title = template.title if matched else self.fallback_title
+        return {'title': title.render(fields), 'content': template.content.render(fields)}
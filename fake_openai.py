@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the OpenAI chat completions API, for load tests.
+
+Point the app at it with OPENAI_BASE_URL=http://127.0.0.1:8001/v1 and any
+OPENAI_API_KEY. Latency, token rate and error injection are set on the
+command line, and can be changed while it runs by POSTing JSON to /_config.
+GET /_stats returns request counters.
+"""
+import argparse
+import json
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = (
+    'once upon a time in a quiet valley there lived a gentle little fox who loved '
+    'to watch the stars every evening the fox would climb the soft green hill and '
+    'count the twinkling lights until the moon smiled down and whispered goodnight '
+    'friends from the forest came along the rabbit the owl and the sleepy bear '
+    'they shared stories of kindness and courage and dreamed of tomorrow'
+).split()
+
+TITLES = ['The Sleepy Star', 'Moonlight Friends', 'The Gentle Fox', 'A Quiet Valley Dream']
+
+ERRORS = {
+    'quota': (429, {
+        'message': 'You exceeded your current quota, please check your plan and billing details.',
+        'type': 'insufficient_quota', 'param': None, 'code': 'insufficient_quota'
+    }),
+    'rate_limit': (429, {
+        'message': 'Rate limit reached for requests. Please try again in 1s.',
+        'type': 'requests', 'param': None, 'code': 'rate_limit_exceeded'
+    }),
+    'api_key': (401, {
+        'message': 'Incorrect API key provided.',
+        'type': 'invalid_request_error', 'param': None, 'code': 'invalid_api_key'
+    }),
+    'server': (500, {
+        'message': 'The server had an error while processing your request.',
+        'type': 'server_error', 'param': None, 'code': None
+    }),
+}
+
+config = {
+    'latency': 0.5,
+    'jitter': 0.1,
+    'tokens_per_second': 60.0,
+    'error_rate': 0.0,
+    'error': 'rate_limit',
+    'timeout_seconds': 120.0,
+    'model': 'gpt-3.5-turbo',
+}
+stats = {'requests': 0, 'streamed': 0, 'errors': 0, 'completion_tokens': 0}
+stats_lock = threading.Lock()
+
+
+def _count(name, amount=1):
+    with stats_lock:
+        stats[name] += amount
+
+
+def estimate_tokens(text):
+    """Rough token count, about four characters per token"""
+    return max(1, len(text) // 4)
+
+
+def apply_stops(reply, stops):
+    """Cut the reply at the first stop sequence it contains"""
+    if isinstance(stops, str):
+        stops = [stops]
+    for stop in stops or []:
+        if stop in reply:
+            reply = reply[:reply.index(stop)]
+    return reply
+
+
+def fit_budget(reply, max_tokens):
+    """(reply, finish_reason) after truncating to the token budget"""
+    if estimate_tokens(reply) > max_tokens:
+        return reply[:max_tokens * 4], 'length'
+    return reply, 'stop'
+
+
+def build_reply(body):
+    """Deterministic text sized from the prompt and max_tokens"""
+    messages = body.get('messages', [])
+    prompt = ' '.join(m.get('content', '') for m in messages)
+    max_tokens = body.get('max_tokens') or 800
+    rng = random.Random(prompt)
+
+    if max_tokens <= 40:
+        return rng.choice(TITLES), 'stop'
+
+    match = re.search(r'Approximately (\d+) words', prompt)
+    words = int(match.group(1)) if match else 300
+    text = []
+    for i in range(words):
+        word = rng.choice(WORDS)
+        text.append(word.capitalize() if i % 12 == 0 else word)
+        if i % 12 == 11:
+            text[-1] += '.'
+        if i % 60 == 59:
+            text[-1] += '\n\n'
+    reply = ' '.join(text).replace('\n\n ', '\n\n').strip()
+    if not reply.endswith('.'):
+        reply += '.'
+    name = re.search(r"Child's name: (.+)", prompt)
+    if name and name.group(1).strip() != '[Child]':
+        # Real stories feature the child, which the cache and warm pool rely on
+        reply = f'Once upon a time there was a child named {name.group(1).strip()}. {reply}'
+    if 'Title:' in prompt:
+        reply = f'Title: {rng.choice(TITLES)}\n\n{reply}'
+    reply += '\n\nThe End.'
+
+    # Honour stop sequences and the token budget like the real API
+    return fit_budget(apply_stops(reply, body.get('stop')), max_tokens)
+
+
+class Server(ThreadingHTTPServer):
+    # The default listen backlog of 5 drops connections under load tests
+    request_queue_size = 1024
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        if self.path == '/_stats':
+            with stats_lock:
+                self._send_json(200, dict(stats, config=config))
+        else:
+            self._send_json(404, {'error': {'message': 'Not found'}})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            self._send_json(400, {'error': {'message': 'Invalid JSON body'}})
+            return
+
+        if self.path == '/_config':
+            config.update({k: v for k, v in body.items() if k in config})
+            self._send_json(200, config)
+        elif self.path.rstrip('/').endswith('/chat/completions'):
+            self._chat_completion(body)
+        else:
+            self._send_json(404, {'error': {'message': 'Not found'}})
+
+    def _chat_completion(self, body):
+        _count('requests')
+        if random.random() < config['error_rate']:
+            _count('errors')
+            if config['error'] == 'timeout':
+                time.sleep(config['timeout_seconds'])
+                self.close_connection = True
+                return
+            status, error = ERRORS[config['error']]
+            headers = {'Retry-After': '1'} if status == 429 else {}
+            self._send_json(status, {'error': error}, headers)
+            return
+
+        reply, finish_reason = build_reply(body)
+        prompt_tokens = estimate_tokens(' '.join(m.get('content', '') for m in body.get('messages', [])))
+        completion_tokens = estimate_tokens(reply)
+        _count('completion_tokens', completion_tokens)
+        completion_id = f'chatcmpl-{uuid.uuid4().hex[:24]}'
+        model = body.get('model') or config['model']
+
+        time.sleep(max(0.0, config['latency'] + random.uniform(-1, 1) * config['jitter']))
+        tps = config['tokens_per_second']
+
+        if body.get('stream'):
+            _count('streamed')
+            self._stream(reply, finish_reason, completion_id, model, tps)
+            return
+
+        if tps > 0:
+            time.sleep(completion_tokens / tps)
+        self._send_json(200, {
+            'id': completion_id,
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': model,
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': reply},
+                'finish_reason': finish_reason
+            }],
+            'usage': {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+                'total_tokens': prompt_tokens + completion_tokens
+            }
+        })
+
+    def _stream(self, reply, finish_reason, completion_id, model, tps):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        def chunk(delta, finish=None):
+            event = {
+                'id': completion_id,
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': model,
+                'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish}]
+            }
+            self._write_chunk(f'data: {json.dumps(event)}\n\n'.encode())
+
+        chunk({'role': 'assistant', 'content': ''})
+        # Roughly one token per piece, matching the real API's granularity
+        for piece in re.findall(r'\S+\s*', reply):
+            if tps > 0:
+                time.sleep(estimate_tokens(piece) / tps)
+            chunk({'content': piece})
+        chunk({}, finish_reason)
+        self._write_chunk(b'data: [DONE]\n\n')
+        self._write_chunk(b'')
+
+    def _write_chunk(self, data):
+        self.wfile.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+        self.wfile.flush()
+
+    def _send_json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Fake OpenAI chat completions server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--latency', type=float, default=config['latency'],
+                        help='seconds before the first token')
+    parser.add_argument('--jitter', type=float, default=config['jitter'],
+                        help='random +/- seconds added to the latency')
+    parser.add_argument('--tokens-per-second', type=float, default=config['tokens_per_second'],
+                        help='generation speed after the first token (0 = instant)')
+    parser.add_argument('--error-rate', type=float, default=config['error_rate'],
+                        help='fraction of requests that fail')
+    parser.add_argument('--error', choices=sorted(ERRORS) + ['timeout'], default=config['error'],
+                        help='kind of failure to inject')
+    parser.add_argument('--timeout-seconds', type=float, default=config['timeout_seconds'],
+                        help='how long a timeout error hangs before closing')
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    args = parser.parse_args(argv)
+
+    config.update(
+        latency=args.latency, jitter=args.jitter, tokens_per_second=args.tokens_per_second,
+        error_rate=args.error_rate, error=args.error, timeout_seconds=args.timeout_seconds
+    )
+
+    server = Server((args.host, args.port), Handler)
+    server.daemon_threads = True
+    server.verbose = args.verbose
+    print(f'Fake OpenAI API listening on http://{args.host}:{args.port}/v1', file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
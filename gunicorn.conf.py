@@ -0,0 +1,46 @@
+"""
+Gunicorn settings, read automatically when gunicorn starts in this directory.
+
+SERVING_MODE picks the worker type:
+- 'sync' (default): one request per worker process at a time.
+- 'gevent': each worker serves up to WORKER_CONNECTIONS requests
+  concurrently. A worker waiting on OpenAI is free to serve other requests
+  meanwhile, so a few processes can hold thousands of slow generations open.
+"""
+import os
+
+serving_mode = os.getenv('SERVING_MODE', 'sync').lower()
+if serving_mode not in ('sync', 'gevent'):
+    raise ValueError(f"SERVING_MODE must be 'sync' or 'gevent', got {serving_mode!r}")
+
+# Worker processes come from WEB_CONCURRENCY, which gunicorn reads itself (default 1)
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+
+if serving_mode == 'gevent':
+    worker_class = 'gevent'
+    worker_connections = int(os.getenv('WORKER_CONNECTIONS', '1000'))
+
+# Story generation can take longer than gunicorn's default 30 second timeout
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '120'))
+graceful_timeout = 30
+keepalive = 5
+
+
+def on_starting(server):
+    """Import the HTTP client before gevent patches the standard library in each worker.
+
+    httpcore imports trio when it is installed, and trio can't be imported once
+    select has been patched.
+    """
+    if serving_mode == 'gevent':
+        import httpx  # noqa: F401
+
+
+def post_worker_init(worker):
+    """Start the job queue and warm pool as soon as a worker boots.
+
+    Otherwise jobs queued before a restart would wait for the worker's first request.
+    """
+    from app import start_background_workers
+
+    start_background_workers()
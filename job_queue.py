@@ -0,0 +1,182 @@
+"""
+Database-backed job queue for story generation.
+
+Jobs are rows in the application database, so they survive worker
+restarts and need no external broker. Each process runs a small pool of
+daemon threads that claim queued rows with a conditional UPDATE, so a job
+is only ever claimed by one worker. Jobs left 'running' by a worker that
+died are put back in the queue once their lease expires, and finished
+jobs are deleted once they are older than the retention period.
+"""
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueue:
+    """Bounded pool of threads working through queued jobs"""
+
+    def __init__(self, app, db, model, handler, workers=2, poll_interval=1.0,
+                 lease_seconds=300, max_attempts=3, retention_seconds=7 * 24 * 3600):
+        self.app = app
+        self.db = db
+        self.model = model
+        self.handler = handler
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retention_seconds = retention_seconds
+        self._threads = []
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._last_recovery = None
+        self._last_purge = None
+
+    def enqueue(self, **fields):
+        """Persist a new queued job and wake a worker"""
+        job = self.model(id=uuid.uuid4().hex, status='queued', **fields)
+        self.db.session.add(job)
+        self.db.session.commit()
+
+        self.start()
+        self._wakeup.set()
+        return job
+
+    def start(self):
+        """Start the worker threads for this process if they aren't running"""
+        if self._threads:
+            return
+
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(
+                    target=self._work, name=f'story-job-{os.getpid()}-{i}', daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def stats(self):
+        """Queue depth, running jobs and wait times, for monitoring"""
+        Job = self.model
+        now = datetime.utcnow()
+        session = self.db.session
+
+        counts = dict(session.query(Job.status, func.count(Job.id)).group_by(Job.status).all())
+        oldest = session.query(func.min(Job.created_date)).filter(Job.status == 'queued').scalar()
+
+        recent = session.query(Job.created_date, Job.started_date).filter(
+            Job.started_date.isnot(None),
+            Job.started_date >= now - timedelta(hours=1)
+        ).all()
+        waits = [(started - created).total_seconds() for created, started in recent]
+
+        return {
+            'queued': counts.get('queued', 0),
+            'running': counts.get('running', 0),
+            'done': counts.get('done', 0),
+            'failed': counts.get('failed', 0),
+            'oldest_queued_seconds': round((now - oldest).total_seconds(), 1) if oldest else 0.0,
+            'avg_wait_seconds_1h': round(sum(waits) / len(waits), 2) if waits else 0.0,
+            'max_wait_seconds_1h': round(max(waits), 2) if waits else 0.0,
+            'workers_per_process': self.workers
+        }
+
+    def _work(self):
+        while True:
+            try:
+                with self.app.app_context():
+                    self._recover_stale()
+                    self._purge_finished()
+                    job = self._claim()
+                    if job is not None:
+                        self._run(job)
+                        continue
+            except Exception:
+                logger.exception('Story job worker failed')
+
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    def _claim(self):
+        """Atomically move the oldest queued job to 'running'"""
+        Job = self.model
+        session = self.db.session
+
+        while True:
+            job_id = session.query(Job.id).filter(Job.status == 'queued').order_by(
+                Job.created_date
+            ).limit(1).scalar()
+            if job_id is None:
+                session.commit()
+                return None
+
+            claimed = session.query(Job).filter(
+                Job.id == job_id, Job.status == 'queued'
+            ).update({
+                'status': 'running',
+                'started_date': datetime.utcnow(),
+                'attempts': Job.attempts + 1
+            }, synchronize_session=False)
+            session.commit()
+
+            if claimed:
+                return session.get(Job, job_id)
+
+    def _run(self, job):
+        try:
+            self.handler(job)
+        except Exception as e:
+            logger.exception('Story job %s failed', job.id)
+            self.db.session.rollback()
+            job.status = 'failed'
+            job.error = f'Server error: {str(e)}'
+        job.finished_date = datetime.utcnow()
+        self.db.session.commit()
+
+    def _recover_stale(self):
+        """Requeue jobs whose worker stopped before finishing them"""
+        if (self._last_recovery is not None
+                and time.monotonic() - self._last_recovery < self.lease_seconds / 2):
+            return
+        self._last_recovery = time.monotonic()
+
+        Job = self.model
+        expired = datetime.utcnow() - timedelta(seconds=self.lease_seconds)
+        stale = Job.query.filter(Job.status == 'running', Job.started_date < expired)
+
+        stale.filter(Job.attempts < self.max_attempts).update(
+            {'status': 'queued', 'started_date': None}, synchronize_session=False
+        )
+        stale.filter(Job.attempts >= self.max_attempts).update(
+            {'status': 'failed', 'error': 'Job did not finish', 'finished_date': datetime.utcnow()},
+            synchronize_session=False
+        )
+        self.db.session.commit()
+
+    def _purge_finished(self):
+        """Delete done and failed jobs past the retention period"""
+        if not self.retention_seconds:
+            return
+        if (self._last_purge is not None
+                and time.monotonic() - self._last_purge < min(3600, self.retention_seconds / 2)):
+            return
+        self._last_purge = time.monotonic()
+
+        Job = self.model
+        cutoff = datetime.utcnow() - timedelta(seconds=self.retention_seconds)
+        deleted = Job.query.filter(
+            Job.status.in_(('done', 'failed')), Job.finished_date < cutoff
+        ).delete(synchronize_session=False)
+        self.db.session.commit()
+        if deleted:
+            logger.info('Deleted %d finished story jobs', deleted)
@@ -0,0 +1,481 @@
+"""
+Request and upstream-call metrics.
+
+Each process keeps counters and histograms in memory. When a metrics
+directory is set, every process also writes a snapshot there every few
+seconds, and ``/metrics`` sums the snapshots of all gunicorn workers.
+Each process writes under a name of its own, so a new worker that reuses
+an old worker's pid can't overwrite its counts. Snapshots of workers that
+have exited are folded into one aggregate file, so the sums never go
+backwards and the directory doesn't grow with every restart.
+"""
+import atexit
+import json
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: snapshots are summed but never folded
+    fcntl = None
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# name: (type, help, buckets)
+DEFINITIONS = {
+    'http_request_duration_seconds': (
+        'histogram', 'Time to produce a response, by route and status', LATENCY_BUCKETS),
+    'http_request_db_seconds': (
+        'histogram', 'Database time spent per request, by route', DB_BUCKETS),
+    'http_request_db_queries_total': (
+        'counter', 'Database queries issued by requests, by route', None),
+    'db_query_duration_seconds': (
+        'histogram', 'Duration of single database queries', DB_BUCKETS),
+    'openai_request_duration_seconds': (
+        'histogram', 'Duration of OpenAI chat completions, by call and outcome', LATENCY_BUCKETS),
+    'openai_tokens_total': (
+        'counter', 'Tokens used by OpenAI chat completions, by call and kind', None),
+    'story_generations_total': (
+        'counter', 'Story generations, by source and outcome', None),
+    'pdf_render_duration_seconds': (
+        'histogram', 'Time to render a PDF, by kind', LATENCY_BUCKETS),
+    'app_startup_seconds': (
+        'histogram', 'Seconds from app import to the end of import and to the first response, per worker',
+        LATENCY_BUCKETS),
+}
+
+AGGREGATE_FILE = 'metrics-aggregate.json'
+LOCK_FILE = 'metrics.lock'
+
+# Short Server-Timing names for the time spent in each dependency
+TIMING_NAMES = {
+    'db': 'Database',
+    'openai': 'OpenAI',
+    'pdf': 'PDF rendering',
+}
+
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    body = ','.join(
+        '{}="{}"'.format(k, v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in pairs
+    )
+    return '{' + body + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def _merge(counters, histograms, snapshot):
+    """Add a snapshot's counters and histogram buckets to the running sums"""
+    for name, labels, value in snapshot['counters']:
+        key = _key(name, dict(labels))
+        counters[key] = counters.get(key, 0) + value
+    for name, labels, values in snapshot['histograms']:
+        key = _key(name, dict(labels))
+        if key in histograms:
+            histograms[key] = [a + b for a, b in zip(histograms[key], values)]
+        else:
+            histograms[key] = list(values)
+
+
+def _serialize(counters, histograms):
+    return {
+        'counters': [[name, labels, value] for (name, labels), value in counters.items()],
+        'histograms': [[name, labels, values] for (name, labels), values in histograms.items()]
+    }
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def histogram_quantile(quantile, buckets, counts):
+    """Estimate a quantile from bucket counts, interpolating like Prometheus"""
+    total = sum(counts)
+    if not total:
+        return None
+    rank = quantile * total
+    cumulative = 0
+    lower = 0.0
+    for bound, count in zip(buckets, counts):
+        if count and cumulative + count >= rank:
+            return lower + (bound - lower) * (rank - cumulative) / count
+        cumulative += count
+        lower = bound
+    # Falls in the +Inf bucket: the highest finite bound is the best estimate
+    return buckets[-1]
+
+
+class Metrics:
+    """Counters and histograms shared by the app, the generator and PDF export"""
+
+    def __init__(self, directory=None, flush_interval=5.0, server_timing=False, stale_seconds=600):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.server_timing = server_timing
+        # Snapshots from another host can't be checked by pid, so they count as dead once this old
+        self.stale_seconds = max(stale_seconds, flush_interval * 10)
+        self.started = time.time()
+        self._identity = None
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def inc(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+        self._ensure_flusher()
+
+    def observe(self, name, seconds, **labels):
+        buckets = DEFINITIONS[name][2]
+        key = _key(name, labels)
+        with self._lock:
+            entry = self._histograms.get(key)
+            if entry is None:
+                # One count per bucket plus +Inf, then the sum
+                entry = self._histograms[key] = [0] * (len(buckets) + 1) + [0.0]
+            for i, bound in enumerate(buckets):
+                if seconds <= bound:
+                    entry[i] += 1
+                    break
+            else:
+                entry[len(buckets)] += 1
+            entry[-1] += seconds
+        self._ensure_flusher()
+
+    @contextmanager
+    def timed(self, name, timing=None, **labels):
+        """Observe the duration of a block, adding it to the request's Server-Timing"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.observe(name, elapsed, **labels)
+            if timing:
+                add_request_time(timing, elapsed)
+
+    def init_app(self, app):
+        """Time every request and every database query"""
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', self._after_cursor_execute)
+
+    def _start_request(self):
+        g.metrics_started = time.perf_counter()
+        g.metrics_timings = {}
+        g.metrics_db_queries = 0
+
+    def _finish_request(self, response):
+        started = g.get('metrics_started')
+        if started is None:
+            return response
+
+        # For streamed responses this is the time to the first byte
+        elapsed = time.perf_counter() - started
+        route = request.endpoint or 'unmatched'
+        self.observe(
+            'http_request_duration_seconds', elapsed,
+            method=request.method, route=route, status=response.status_code
+        )
+        timings = g.metrics_timings
+        self.observe('http_request_db_seconds', timings.get('db', 0.0), route=route)
+        if g.metrics_db_queries:
+            self.inc('http_request_db_queries_total', g.metrics_db_queries, route=route)
+
+        if self.server_timing:
+            entries = [
+                f'{name};desc="{TIMING_NAMES[name]}";dur={seconds * 1000:.1f}'
+                for name, seconds in timings.items()
+            ]
+            entries.append(f'app;dur={elapsed * 1000:.1f}')
+            response.headers['Server-Timing'] = ', '.join(entries)
+        return response
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get('metrics_query_start')
+        if not starts:
+            return
+        elapsed = time.perf_counter() - starts.pop()
+        self.observe('db_query_duration_seconds', elapsed)
+        if has_request_context() and 'metrics_timings' in g:
+            add_request_time('db', elapsed)
+            g.metrics_db_queries += 1
+
+    def collect(self):
+        """Counters and histograms summed over every process that wrote a snapshot"""
+        own = self._snapshot()
+        if not self.directory:
+            return own
+        self.write_snapshot(own)
+
+        counters, histograms = {}, {}
+        # Folding and reading happen under one lock, so a scrape never sees a dead worker's counts
+        # both in its snapshot and in the aggregate, or in neither
+        with self._directory_lock():
+            aggregate = self._fold_dead_workers()
+            folded = set(aggregate['folded'])
+            _merge(counters, histograms, aggregate)
+            for filename, snapshot in self._read_snapshots():
+                if filename not in folded:
+                    _merge(counters, histograms, snapshot)
+        return {'counters': counters, 'histograms': histograms}
+
+    def render_prometheus(self):
+        """All metrics in the Prometheus text exposition format"""
+        data = self.collect()
+        by_name = {}
+        for (name, labels), value in data['counters'].items():
+            by_name.setdefault(name, []).append((labels, value))
+        for (name, labels), values in data['histograms'].items():
+            by_name.setdefault(name, []).append((labels, values))
+
+        lines = []
+        for name, (kind, help_text, buckets) in DEFINITIONS.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in sorted(by_name.get(name, [])):
+                if kind == 'counter':
+                    lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(list(buckets) + ['+Inf'], value[:-1]):
+                    cumulative += count
+                    le = bound if bound == '+Inf' else _format_value(bound)
+                    lines.append(
+                        f'{name}_bucket{_format_labels(labels, [("le", le)])} {cumulative}'
+                    )
+                lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(value[-1])}')
+                lines.append(f'{name}_count{_format_labels(labels)} {cumulative}')
+        lines.append('# HELP process_uptime_seconds Seconds since this process started')
+        lines.append('# TYPE process_uptime_seconds gauge')
+        lines.append(f'process_uptime_seconds {time.time() - self.started:.1f}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """Request, OpenAI, database and PDF health figures for /api/status"""
+        data = self.collect()
+
+        def histograms(name, **match):
+            wanted = {(k, str(v)) for k, v in match.items()}
+            for (metric, labels), values in data['histograms'].items():
+                if metric == name and wanted <= set(labels):
+                    yield dict(labels), values
+
+        def latency(name, **match):
+            buckets = DEFINITIONS[name][2]
+            counts = [0] * (len(buckets) + 1)
+            total = 0.0
+            for _, values in histograms(name, **match):
+                counts = [a + b for a, b in zip(counts, values[:-1])]
+                total += values[-1]
+            count = sum(counts)
+            p95 = histogram_quantile(0.95, buckets, counts)
+            return {
+                'count': count,
+                'avg_ms': round(total / count * 1000, 1) if count else None,
+                'p95_ms': round(p95 * 1000, 1) if p95 is not None else None
+            }
+
+        requests = latency('http_request_duration_seconds')
+        server_errors = sum(
+            sum(values[:-1]) for labels, values in histograms('http_request_duration_seconds')
+            if labels['status'].startswith('5')
+        )
+        openai_errors = {}
+        for labels, values in histograms('openai_request_duration_seconds'):
+            if labels['outcome'] != 'ok':
+                openai_errors[labels['outcome']] = openai_errors.get(labels['outcome'], 0) + sum(values[:-1])
+        tokens = {}
+        for (metric, labels), value in data['counters'].items():
+            if metric == 'openai_tokens_total':
+                kind = dict(labels)['kind']
+                tokens[kind] = tokens.get(kind, 0) + value
+        db_queries = sum(
+            value for (metric, _), value in data['counters'].items()
+            if metric == 'http_request_db_queries_total'
+        )
+        db_time = latency('http_request_db_seconds')
+
+        return {
+            'uptime_seconds': round(time.time() - self.started, 1),
+            'requests': dict(requests, server_errors=server_errors),
+            'openai': dict(
+                latency('openai_request_duration_seconds', outcome='ok'),
+                errors=openai_errors,
+                tokens=tokens
+            ),
+            'db': {
+                'avg_ms_per_request': db_time['avg_ms'],
+                'queries_per_request': round(db_queries / db_time['count'], 2) if db_time['count'] else None,
+                'query': latency('db_query_duration_seconds')
+            },
+            'pdf': latency('pdf_render_duration_seconds'),
+            'startup': {
+                'import': latency('app_startup_seconds', phase='import'),
+                'first_request': latency('app_startup_seconds', phase='first_request')
+            }
+        }
+
+    def write_snapshot(self, snapshot=None):
+        """Publish this process's metrics for the other workers to read"""
+        if not self.directory:
+            return
+        snapshot = snapshot or self._snapshot()
+        data = dict(
+            _serialize(snapshot['counters'], snapshot['histograms']),
+            pid=os.getpid(),
+            host=socket.gethostname()
+        )
+        try:
+            self._write_json(self._snapshot_name(), data)
+        except OSError:
+            logger.exception('Could not write metrics snapshot')
+
+    def _snapshot_name(self):
+        pid = os.getpid()
+        if self._identity is None or self._identity[0] != pid:
+            # Checked per call, as a forked worker inherits its parent's Metrics
+            self._identity = (pid, f'metrics-{pid}-{uuid.uuid4().hex[:12]}.json')
+        return self._identity[1]
+
+    def _write_json(self, filename, data):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, os.path.join(self.directory, filename))
+
+    def _read_snapshots(self):
+        """(filename, snapshot) for every worker snapshot in the directory"""
+        for filename in os.listdir(self.directory):
+            if filename == AGGREGATE_FILE or not (filename.startswith('metrics-') and filename.endswith('.json')):
+                continue
+            try:
+                with open(os.path.join(self.directory, filename)) as f:
+                    yield filename, json.load(f)
+            except (OSError, ValueError):
+                continue
+
+    @contextmanager
+    def _directory_lock(self):
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.directory, LOCK_FILE), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _is_dead(self, filename, snapshot):
+        if filename == self._snapshot_name():
+            return False
+        if snapshot.get('host') == socket.gethostname() and not _pid_alive(snapshot['pid']):
+            return True
+        try:
+            return time.time() - os.path.getmtime(os.path.join(self.directory, filename)) > self.stale_seconds
+        except OSError:
+            return False
+
+    def _fold_dead_workers(self):
+        """Move the counts of workers that have exited into the aggregate file; returns the aggregate.
+
+        The aggregate lists the files folded into it, and they are removed only
+        after it is written, so a crash in between can't count a worker twice.
+        """
+        path = os.path.join(self.directory, AGGREGATE_FILE)
+        try:
+            with open(path) as f:
+                aggregate = json.load(f)
+        except FileNotFoundError:
+            aggregate = {'counters': [], 'histograms': [], 'folded': []}
+        if fcntl is None:
+            return aggregate
+
+        snapshots = dict(self._read_snapshots())
+        folded = [filename for filename in aggregate['folded'] if filename in snapshots]
+        dead = [
+            filename for filename, snapshot in snapshots.items()
+            if filename not in folded and self._is_dead(filename, snapshot)
+        ]
+        if not dead and len(folded) == len(aggregate['folded']):
+            return aggregate
+
+        counters, histograms = {}, {}
+        _merge(counters, histograms, aggregate)
+        for filename in dead:
+            _merge(counters, histograms, snapshots[filename])
+        aggregate = dict(_serialize(counters, histograms), folded=folded + dead)
+        self._write_json(AGGREGATE_FILE, aggregate)
+        for filename in aggregate['folded']:
+            try:
+                os.remove(os.path.join(self.directory, filename))
+            except FileNotFoundError:
+                pass
+        return aggregate
+
+    def _snapshot(self):
+        with self._lock:
+            return {
+                'counters': dict(self._counters),
+                'histograms': {key: list(values) for key, values in self._histograms.items()}
+            }
+
+    def _ensure_flusher(self):
+        if not self.directory or self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='metrics-flush', daemon=True)
+            self._thread.start()
+            atexit.register(self.write_snapshot)
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.write_snapshot()
+
+
+def add_request_time(name, seconds):
+    """Add time spent in a dependency to the current request's Server-Timing"""
+    if has_request_context() and 'metrics_timings' in g:
+        g.metrics_timings[name] = g.metrics_timings.get(name, 0.0) + seconds
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_query_start', []).append(time.perf_counter())
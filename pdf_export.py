@@ -0,0 +1,256 @@
+"""
+PDF export for stories.
+
+Paragraph styles are built once per process. Rendered PDFs are cached per
+story id and content version, in memory and optionally in a directory that
+all workers share. Multi-story exports are produced as one bound PDF or a
+ZIP of single-story PDFs and are streamed to the client in chunks.
+reportlab is only imported when the first PDF is rendered.
+"""
+import glob
+import hashlib
+import os
+import tempfile
+import threading
+import zipfile
+from collections import OrderedDict
+from functools import lru_cache
+
+CHUNK_SIZE = 64 * 1024
+
+
+@lru_cache(maxsize=None)
+def _styles():
+    """Paragraph styles shared by every rendered document"""
+    from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
+
+    styles = getSampleStyleSheet()
+    return {
+        'title': ParagraphStyle(
+            'CustomTitle',
+            parent=styles['Heading1'],
+            fontSize=18,
+            spaceAfter=30,
+            alignment=1  # Center alignment
+        ),
+        'content': ParagraphStyle(
+            'CustomContent',
+            parent=styles['Normal'],
+            fontSize=12,
+            lineHeight=14,
+            spaceAfter=12
+        ),
+        'metadata': ParagraphStyle(
+            'Metadata',
+            parent=styles['Normal'],
+            fontSize=10,
+            textColor='gray'
+        )
+    }
+
+
+def story_version(story):
+    """Hash of every story field that appears in the PDF"""
+    fields = (
+        story.title, story.content, story.theme, story.age_group,
+        story.child_name or '', story.created_date.isoformat()
+    )
+    return hashlib.sha1('\x1f'.join(fields).encode('utf-8')).hexdigest()[:16]
+
+
+def _story_elements(story):
+    """Flowables for one story: title, paragraphs and metadata"""
+    from reportlab.platypus import Paragraph, Spacer
+
+    styles = _styles()
+    story_elements = []
+
+    # Add title
+    story_elements.append(Paragraph(story.title, styles['title']))
+    story_elements.append(Spacer(1, 20))
+
+    # Add story content with proper paragraph breaks
+    for paragraph in story.content.split('\n\n'):
+        if paragraph.strip():
+            story_elements.append(Paragraph(paragraph.strip(), styles['content']))
+            story_elements.append(Spacer(1, 12))
+
+    # Add metadata
+    story_elements.append(Spacer(1, 30))
+    metadata = (
+        f"Generated on: {story.created_date.strftime('%B %d, %Y')}"
+        f"<br/>Theme: {story.theme}<br/>Age Group: {story.age_group}"
+    )
+    if story.child_name:
+        metadata += f"<br/>Created for: {story.child_name}"
+    story_elements.append(Paragraph(metadata, styles['metadata']))
+
+    return story_elements
+
+
+def _build(elements, fileobj):
+    from reportlab.lib.pagesizes import letter
+    from reportlab.lib.units import inch
+    from reportlab.platypus import SimpleDocTemplate
+
+    doc = SimpleDocTemplate(fileobj, pagesize=letter, topMargin=1*inch, bottomMargin=1*inch)
+    doc.build(elements)
+
+
+def render_story_pdf(story):
+    """Render a single story and return the PDF bytes"""
+    with tempfile.SpooledTemporaryFile() as buffer:
+        _build(_story_elements(story), buffer)
+        buffer.seek(0)
+        return buffer.read()
+
+
+def render_book(stories, fileobj):
+    """Render several stories into one PDF, each starting on a new page"""
+    from reportlab.platypus import PageBreak
+
+    elements = []
+    for story in stories:
+        if elements:
+            elements.append(PageBreak())
+        elements.extend(_story_elements(story))
+    _build(elements, fileobj)
+
+
+def stream_book(stories):
+    """Render a bound PDF and yield it in chunks.
+
+    The document is spooled to a temporary file, which only stays in memory
+    while it is small.
+    """
+    with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as spool:
+        render_book(stories, spool)
+        spool.seek(0)
+        while True:
+            chunk = spool.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+class _ChunkSink:
+    """Write-only file object that collects bytes for a streaming response"""
+
+    def __init__(self):
+        self._chunks = []
+        self._offset = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._offset
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_zip(stories, render):
+    """Yield a ZIP archive of one PDF per story, as each PDF is added.
+
+    ``render`` maps a story to its PDF bytes, so cached PDFs can be reused.
+    """
+    sink = _ChunkSink()
+    used_names = set()
+    with zipfile.ZipFile(sink, mode='w', compression=zipfile.ZIP_STORED) as archive:
+        for story in stories:
+            name = pdf_filename(story)
+            if name in used_names:
+                name = f'{story.id}_{name}'
+            used_names.add(name)
+
+            archive.writestr(name, render(story))
+            data = sink.drain()
+            if data:
+                yield data
+    yield sink.drain()
+
+
+def pdf_filename(story):
+    """Download filename for a story's PDF"""
+    return f"{story.title.replace(' ', '_')}.pdf"
+
+
+class PdfCache:
+    """LRU cache of rendered PDFs keyed by story id and version.
+
+    When ``directory`` is set, PDFs are also written there so that other
+    worker processes can reuse them.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def get(self, story_id, version):
+        key = (story_id, version)
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                return data
+
+        if self.directory:
+            try:
+                with open(self._path(story_id, version), 'rb') as f:
+                    data = f.read()
+            except OSError:
+                return None
+            self._remember(key, data)
+            return data
+        return None
+
+    def put(self, story_id, version, data):
+        self._remember((story_id, version), data)
+
+        if self.directory:
+            path = self._path(story_id, version)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+    def invalidate(self, story_id):
+        """Drop every cached version of a story"""
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == story_id]:
+                self._size -= len(self._entries.pop(key))
+
+        if self.directory:
+            for path in glob.glob(os.path.join(self.directory, f'{story_id}-*.pdf')):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def _remember(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._size -= len(self._entries.pop(key))
+            self._entries[key] = data
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def _path(self, story_id, version):
+        return os.path.join(self.directory, f'{story_id}-{version}.pdf')
@@ -0,0 +1,176 @@
+"""
+Theme popularity counting.
+
+Counts are applied with a single INSERT ... ON CONFLICT DO UPDATE per
+batch, so concurrent workers never lose increments or collide when they
+create the same new theme. With a flush interval set, counts are
+aggregated in memory and written in batches from a background thread,
+keeping the theme rows out of the request transaction entirely.
+"""
+import atexit
+import logging
+import threading
+from collections import Counter
+
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+logger = logging.getLogger(__name__)
+
+_UPSERT_INSERTS = {
+    'sqlite': sqlite_insert,
+    'postgresql': postgresql_insert,
+}
+
+
+def increment_theme_counts(session, model, counts, labels=None):
+    """Add ``counts`` ({theme name: n}) to each theme's popularity score.
+
+    Themes that don't exist yet are created as user-generated themes.
+    ``labels`` optionally maps a name to the wording used in its description.
+    """
+    if not counts:
+        return
+
+    labels = labels or {}
+    table = model.__table__
+    # Sorted so concurrent batches lock theme rows in the same order
+    rows = [
+        {
+            'name': name,
+            'description': f"Stories about {labels.get(name, name)}",
+            'category': 'user_generated',
+            'popularity_score': counts[name]
+        }
+        for name in sorted(counts)
+    ]
+
+    insert = _UPSERT_INSERTS.get(session.get_bind().dialect.name)
+    if insert is not None:
+        stmt = insert(table).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.name],
+            set_={'popularity_score': table.c.popularity_score + stmt.excluded.popularity_score}
+        )
+        session.execute(stmt)
+        return
+
+    # Other databases: increment in place, inserting the themes that were missing
+    for row in rows:
+        updated = session.execute(
+            table.update()
+            .where(table.c.name == row['name'])
+            .values(popularity_score=table.c.popularity_score + row['popularity_score'])
+        )
+        if updated.rowcount == 0:
+            session.execute(table.insert().values(**row))
+
+
+def rebuild_theme_popularity(session, model, story_model):
+    """Reset every theme's popularity score to its number of stories.
+
+    The counts come from one GROUP BY over the stories and are written with
+    the same upsert as live counting, so themes missing from the theme table
+    are created. Returns the number of distinct themes found.
+    """
+    counts = Counter()
+    labels = {}
+    rows = session.execute(select(story_model.theme, func.count()).group_by(story_model.theme))
+    for theme, count in rows:
+        name = theme.lower()
+        counts[name] += count
+        labels.setdefault(name, theme)
+
+    session.execute(model.__table__.update().values(popularity_score=0))
+    increment_theme_counts(session, model, counts, labels)
+    return len(counts)
+
+
+class ThemeCounter:
+    """Records theme usage, either immediately or through a flush buffer"""
+
+    def __init__(self, app, db, model, flush_interval=0):
+        self.app = app
+        self.db = db
+        self.model = model
+        self.flush_interval = flush_interval
+        self._counts = Counter()
+        self._labels = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    def record(self, theme, count=1):
+        """Count uses of a theme.
+
+        Without buffering the increment joins the caller's transaction, so it
+        is committed together with the story.
+        """
+        self.record_many({theme: count})
+
+    def record_many(self, themes):
+        """Count uses of several themes at once, from {theme: count}.
+
+        Themes that differ only in case are added up, so a whole batch is
+        applied in one upsert.
+        """
+        counts = Counter()
+        labels = {}
+        for theme, count in themes.items():
+            name = theme.lower()
+            counts[name] += count
+            labels.setdefault(name, theme)
+        if not counts:
+            return
+
+        if self.flush_interval <= 0:
+            increment_theme_counts(self.db.session, self.model, counts, labels)
+            return
+
+        with self._lock:
+            self._counts.update(counts)
+            for name, label in labels.items():
+                self._labels.setdefault(name, label)
+        self._ensure_flusher()
+
+    def pending(self):
+        """Counts waiting to be flushed"""
+        with self._lock:
+            return sum(self._counts.values())
+
+    def flush(self):
+        """Write buffered counts in one upsert"""
+        with self._lock:
+            counts, labels = self._counts, self._labels
+            self._counts, self._labels = Counter(), {}
+        if not counts:
+            return
+
+        with self.app.app_context():
+            try:
+                increment_theme_counts(self.db.session, self.model, counts, labels)
+                self.db.session.commit()
+            except Exception:
+                self.db.session.rollback()
+                logger.exception('Theme popularity flush failed; keeping counts for retry')
+                with self._lock:
+                    self._counts.update(counts)
+                    for name, label in labels.items():
+                        self._labels.setdefault(name, label)
+
+    def _ensure_flusher(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(
+                target=self._run, name='theme-counter', daemon=True
+            )
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
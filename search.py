@@ -0,0 +1,202 @@
+"""
+Full-text search over saved stories.
+
+SQLite uses an external-content FTS5 table that triggers keep in step
+with every INSERT, UPDATE and DELETE on ``story``. Postgres uses a
+generated ``tsvector`` column with a GIN index. Other databases, or
+SQLite builds without FTS5, fall back to a LIKE scan.
+"""
+import re
+
+from markupsafe import escape
+from sqlalchemy import DateTime, text
+
+# Control characters mark highlighted terms until the snippet has been escaped
+_MARK_START = '\x02'
+_MARK_END = '\x03'
+
+_SQLITE_SCHEMA = [
+    """
+    CREATE VIRTUAL TABLE story_fts USING fts5(
+        title, content, theme, child_name, user_notes,
+        content='story', content_rowid='id', tokenize='porter unicode61'
+    )
+    """,
+    # Column weights for the built-in rank: title, content, theme, child_name, user_notes
+    "INSERT INTO story_fts (story_fts, rank) VALUES ('rank', 'bm25(10.0, 1.0, 5.0, 5.0, 2.0)')",
+    """
+    CREATE TRIGGER IF NOT EXISTS story_fts_insert AFTER INSERT ON story BEGIN
+        INSERT INTO story_fts (rowid, title, content, theme, child_name, user_notes)
+        VALUES (new.id, new.title, new.content, new.theme, new.child_name, new.user_notes);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS story_fts_delete AFTER DELETE ON story BEGIN
+        INSERT INTO story_fts (story_fts, rowid, title, content, theme, child_name, user_notes)
+        VALUES ('delete', old.id, old.title, old.content, old.theme, old.child_name, old.user_notes);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS story_fts_update
+    AFTER UPDATE OF title, content, theme, child_name, user_notes ON story BEGIN
+        INSERT INTO story_fts (story_fts, rowid, title, content, theme, child_name, user_notes)
+        VALUES ('delete', old.id, old.title, old.content, old.theme, old.child_name, old.user_notes);
+        INSERT INTO story_fts (rowid, title, content, theme, child_name, user_notes)
+        VALUES (new.id, new.title, new.content, new.theme, new.child_name, new.user_notes);
+    END
+    """,
+]
+
+_POSTGRES_SCHEMA = [
+    """
+    ALTER TABLE story ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (
+        setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(theme, '') || ' ' || coalesce(child_name, '')), 'B') ||
+        setweight(to_tsvector('english', coalesce(content, '')), 'C') ||
+        setweight(to_tsvector('english', coalesce(user_notes, '')), 'D')
+    ) STORED
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_story_search_vector ON story USING GIN (search_vector)",
+]
+
+# Ordering by the built-in rank column lets FTS5 rank without a separate sort pass
+_SQLITE_SEARCH = text("""
+    SELECT s.id, s.title, s.theme, s.child_name, s.created_date, rank,
+           snippet(story_fts, -1, :mark_start, :mark_end, '…', 16) AS snippet
+    FROM story_fts
+    JOIN story s ON s.id = story_fts.rowid
+    WHERE story_fts MATCH :query
+    ORDER BY rank
+    LIMIT :limit
+""").columns(created_date=DateTime)
+
+# Headlines are only built for the rows that make the page
+_POSTGRES_SEARCH = text("""
+    SELECT hits.id, hits.title, hits.theme, hits.child_name, hits.created_date, hits.rank,
+           ts_headline('english', hits.content, to_tsquery('english', :query), :headline_options) AS snippet
+    FROM (
+        SELECT id, title, theme, child_name, created_date, content,
+               ts_rank_cd(search_vector, to_tsquery('english', :query)) AS rank
+        FROM story
+        WHERE search_vector @@ to_tsquery('english', :query)
+        ORDER BY rank DESC
+        LIMIT :limit
+    ) hits
+    ORDER BY hits.rank DESC
+""").columns(created_date=DateTime)
+
+
+def search_backend(engine):
+    """Name of the search implementation available on this database"""
+    if engine.dialect.name == 'postgresql':
+        return 'postgres'
+    if engine.dialect.name == 'sqlite':
+        with engine.connect() as conn:
+            options = conn.exec_driver_sql('PRAGMA compile_options').scalars().all()
+        if 'ENABLE_FTS5' in options:
+            return 'fts5'
+    return 'like'
+
+
+def setup_search(engine):
+    """Create the search index and the objects that keep it up to date"""
+    backend = search_backend(engine)
+    with engine.begin() as conn:
+        if backend == 'fts5':
+            exists = conn.exec_driver_sql(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'story_fts'"
+            ).scalar()
+            if not exists:
+                conn.exec_driver_sql(_SQLITE_SCHEMA[0])
+                # Index the stories saved before search existed
+                conn.exec_driver_sql("INSERT INTO story_fts (story_fts) VALUES ('rebuild')")
+            for statement in _SQLITE_SCHEMA[1:]:
+                conn.exec_driver_sql(statement)
+        elif backend == 'postgres':
+            for statement in _POSTGRES_SCHEMA:
+                conn.exec_driver_sql(statement)
+    return backend
+
+
+def _terms(query):
+    return re.findall(r'\w+', query.lower())
+
+
+def _highlight(snippet):
+    """Escape a snippet and turn the match markers into <mark> tags"""
+    html = str(escape(snippet or ''))
+    return html.replace(_MARK_START, '<mark>').replace(_MARK_END, '</mark>')
+
+
+def search_stories(session, backend, query, limit=20):
+    """Ranked stories matching ``query``, each with a highlighted snippet.
+
+    Every term must match. If the exact terms find fewer than ``limit``
+    stories, the last term is also tried as a prefix so results follow
+    typing. Short prefixes are skipped because they expand to too many terms.
+    ``created_date`` is a datetime on every backend; SQLite stores it as text.
+    """
+    terms = _terms(query)
+    if not terms:
+        return []
+
+    rows = _run_search(session, backend, terms, limit, prefix=False)
+    if len(rows) < limit and len(terms[-1]) >= 3 and backend != 'like':
+        seen = {row['id'] for row in rows}
+        more = _run_search(session, backend, terms, limit, prefix=True)
+        rows += [row for row in more if row['id'] not in seen][:limit - len(rows)]
+
+    return [{
+        'id': row['id'],
+        'title': row['title'],
+        'theme': row['theme'],
+        'child_name': row['child_name'],
+        'created_date': row['created_date'],
+        'snippet_html': _highlight(row['snippet'])
+    } for row in rows]
+
+
+def _run_search(session, backend, terms, limit, prefix):
+    if backend == 'fts5':
+        fts_query = ' '.join(f'"{term}"' for term in terms) + ('*' if prefix else '')
+        return list(session.execute(_SQLITE_SEARCH, {
+            'query': fts_query, 'limit': limit,
+            'mark_start': _MARK_START, 'mark_end': _MARK_END
+        }).mappings())
+    if backend == 'postgres':
+        ts_query = ' & '.join(terms[:-1] + [terms[-1] + (':*' if prefix else '')])
+        return list(session.execute(_POSTGRES_SEARCH, {
+            'query': ts_query, 'limit': limit,
+            'headline_options': (
+                f'StartSel={_MARK_START}, StopSel={_MARK_END}, '
+                'MaxFragments=1, MaxWords=24, MinWords=8'
+            )
+        }).mappings())
+    return _like_search(session, terms, limit)
+
+
+def _like_search(session, terms, limit):
+    """Unindexed fallback: every term must appear in one of the fields"""
+    fields = "coalesce(title, '') || ' ' || coalesce(content, '') || ' ' || theme || ' ' || " \
+             "coalesce(child_name, '') || ' ' || coalesce(user_notes, '')"
+    clauses = ' AND '.join(f'lower({fields}) LIKE :term{i}' for i in range(len(terms)))
+    params = {f'term{i}': f'%{term}%' for i, term in enumerate(terms)}
+    params['limit'] = limit
+
+    rows = session.execute(text(
+        f'SELECT id, title, theme, child_name, created_date, content FROM story '
+        f'WHERE {clauses} ORDER BY created_date DESC LIMIT :limit'
+    ).columns(created_date=DateTime), params).mappings().all()
+
+    results = []
+    for row in rows:
+        content = row['content']
+        position = max(content.lower().find(terms[0]), 0)
+        start = max(position - 60, 0)
+        excerpt = content[start:start + 160]
+        excerpt = re.sub(
+            f'({re.escape(terms[0])})', f'{_MARK_START}\\1{_MARK_END}', excerpt, flags=re.IGNORECASE
+        )
+        results.append(dict(row, snippet=('…' if start else '') + excerpt + '…'))
+    return results
@@ -0,0 +1,41 @@
+"""
+Connections to a SQLite file shared by every worker process.
+
+``SqliteFile`` is the base of the stores that keep cross-worker state in
+SQLite: the story cache, the warm pool and the rate limiter. Each thread
+gets its own connection in autocommit mode with WAL journaling, so readers
+don't block the writer, and callers open ``BEGIN IMMEDIATE`` transactions
+themselves where they need one.
+"""
+import os
+import sqlite3
+import threading
+
+
+class SqliteFile:
+    """Per-thread connections to the SQLite file at ``path``.
+
+    Subclasses create their tables in ``_create_schema``, which runs once
+    on first use, so importing the app touches no files.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._schema_ready = False
+
+    def _create_schema(self, conn):
+        raise NotImplementedError
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            if not self._schema_ready:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            if not self._schema_ready:
+                self._create_schema(conn)
+                self._schema_ready = True
+            self._local.conn = conn
+        return conn
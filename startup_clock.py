@@ -0,0 +1,9 @@
+"""
+When the app started importing.
+
+app.py imports this module before anything else, so the time recorded
+here includes loading Flask, SQLAlchemy and the rest of the app.
+"""
+import time
+
+IMPORT_STARTED = time.perf_counter()
@@ -0,0 +1,195 @@
+"""
+NDJSON export and import of the story library.
+
+The export reads plain column tuples with ``yield_per``, which uses a
+server-side cursor where the database has one, and streams one JSON
+object per line. Nothing accumulates in the session, so memory stays
+flat however large the library is. The import parses lines lazily and
+writes them with one multi-row insert per batch, committing each batch.
+"""
+import gzip
+import io
+import json
+import zlib
+from datetime import datetime
+
+from sqlalchemy import select, text
+from sqlalchemy.exc import IntegrityError
+
+EXPORT_FIELDS = (
+    'id', 'title', 'content', 'theme', 'age_group', 'child_name', 'story_length',
+    'created_date', 'updated_date', 'version', 'user_notes',
+    'prompt_tokens', 'completion_tokens', 'generation_ms'
+)
+REQUIRED_FIELDS = ('title', 'content', 'theme', 'age_group')
+DATE_FIELDS = ('created_date', 'updated_date')
+USAGE_FIELDS = ('prompt_tokens', 'completion_tokens', 'generation_ms')
+
+
+class DuplicateId(ValueError):
+    """An imported story's id is already taken"""
+
+
+def export_lines(session, model, batch_size=1000):
+    """One NDJSON line per story, in id order"""
+    columns = [getattr(model, field) for field in EXPORT_FIELDS]
+    stmt = select(*columns).order_by(model.id).execution_options(yield_per=batch_size)
+    for row in session.execute(stmt):
+        record = row._asdict()
+        for field in DATE_FIELDS:
+            if record[field] is not None:
+                record[field] = record[field].isoformat()
+        yield json.dumps(record, ensure_ascii=False) + '\n'
+
+
+def encode_chunks(lines, compress=False, chunk_size=64 * 1024):
+    """Join lines into byte chunks of about ``chunk_size``, gzip-compressed if asked"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16) if compress else None
+    buffer = []
+    size = 0
+    for line in lines:
+        data = line.encode('utf-8')
+        buffer.append(data)
+        size += len(data)
+        if size >= chunk_size:
+            chunk = b''.join(buffer)
+            buffer, size = [], 0
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+            if chunk:
+                yield chunk
+
+    chunk = b''.join(buffer)
+    if compressor is not None:
+        chunk = compressor.compress(chunk) + compressor.flush()
+    if chunk:
+        yield chunk
+
+
+def open_lines(binary):
+    """Text lines from a binary NDJSON file, which may be gzip-compressed"""
+    if binary.peek(2)[:2] == b'\x1f\x8b':
+        binary = gzip.GzipFile(fileobj=binary)
+    return io.TextIOWrapper(binary, encoding='utf-8')
+
+
+def _parse_date(value):
+    if not value:
+        return None
+    return datetime.fromisoformat(value)
+
+
+def story_row(record, keep_ids=False):
+    """Column values for one exported story; raises ValueError if it is unusable"""
+    if not isinstance(record, dict):
+        raise ValueError('line is not a JSON object')
+    missing = [field for field in REQUIRED_FIELDS if not record.get(field)]
+    if missing:
+        raise ValueError(f"missing {', '.join(missing)}")
+
+    created_date = _parse_date(record.get('created_date')) or datetime.utcnow()
+    row = {
+        'title': str(record['title']),
+        'content': str(record['content']),
+        'theme': str(record['theme']),
+        'age_group': str(record['age_group']),
+        'child_name': record.get('child_name') or None,
+        'story_length': record.get('story_length') or 'medium',
+        'created_date': created_date,
+        'updated_date': _parse_date(record.get('updated_date')) or created_date,
+        'version': int(record.get('version') or 1),
+        'user_notes': record.get('user_notes') or None,
+    }
+    for field in USAGE_FIELDS:
+        row[field] = None if record.get(field) is None else int(record[field])
+    if keep_ids:
+        if record.get('id') is None:
+            raise ValueError('missing id')
+        row['id'] = int(record['id'])
+    return row
+
+
+def parse_lines(lines, keep_ids=False, on_error=None):
+    """(line number, column values) for each usable line; blank lines are skipped, bad ones reported"""
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            row = story_row(json.loads(line), keep_ids)
+        except (ValueError, TypeError) as e:
+            if on_error is not None:
+                on_error(number, e)
+            continue
+        yield number, row
+
+
+def _free_id_rows(session, table, batch, on_error):
+    """The rows of ``batch`` whose ids are not taken; the others are reported as DuplicateId"""
+    ids = [row['id'] for _, row in batch]
+    taken = set(session.scalars(select(table.c.id).where(table.c.id.in_(ids))))
+    free = []
+    for number, row in batch:
+        if row['id'] in taken:
+            on_error(number, DuplicateId(f"story id {row['id']} already exists"))
+        else:
+            taken.add(row['id'])
+            free.append((number, row))
+    return free
+
+
+def _insert_batch(session, table, batch, keep_ids, on_error):
+    """Insert and commit one batch of (line number, row); returns how many rows went in"""
+    rows = batch
+    try:
+        session.execute(table.insert(), [row for _, row in rows])
+    except IntegrityError:
+        session.rollback()
+        if not keep_ids:
+            raise
+        # Some ids are taken: report those lines and insert the rest of the batch
+        rows = _free_id_rows(session, table, rows, on_error)
+        if rows:
+            session.execute(table.insert(), [row for _, row in rows])
+    session.commit()
+    return len(rows)
+
+
+def import_lines(session, model, lines, prepare=None, batch_size=1000, keep_ids=False, on_error=None):
+    """Insert stories from NDJSON lines in batches; returns (imported, skipped).
+
+    ``prepare`` may add derived columns to each row. Lines that can't be
+    parsed are skipped and passed to ``on_error(line_number, error)``, and
+    so are lines whose id is already taken when ``keep_ids`` is set, as a
+    DuplicateId. Each batch is committed, so an interrupted import keeps
+    what it wrote.
+    """
+    table = model.__table__
+    batch = []
+    imported = skipped = 0
+
+    def flush():
+        return _insert_batch(session, table, batch, keep_ids, report)
+
+    def report(number, error):
+        nonlocal skipped
+        skipped += 1
+        if on_error is not None:
+            on_error(number, error)
+
+    for number, row in parse_lines(lines, keep_ids, report):
+        if prepare is not None:
+            prepare(row)
+        batch.append((number, row))
+        if len(batch) >= batch_size:
+            imported += flush()
+            batch = []
+    if batch:
+        imported += flush()
+
+    if keep_ids and session.get_bind().dialect.name == 'postgresql':
+        # Explicit ids don't advance the id sequence, so move it past them
+        session.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), COALESCE(MAX(id), 1)) FROM {table.name}"
+        ))
+        session.commit()
+    return imported, skipped
@@ -0,0 +1,275 @@
+"""
+Generation result cache for StoryGenerator.
+
+Stories are cached per normalized (theme, age_group, story_length). The
+child's name is swapped for a placeholder before a story is stored and
+swapped back in on a hit, so one cached story serves every child. Each key
+keeps up to ``variants`` stories, served round-robin once the key is full.
+"""
+import logging
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from sqlite_file import SqliteFile
+
+NAME_PLACEHOLDER = '{child_name}'
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_theme(theme):
+    """Lowercase a theme and collapse punctuation and whitespace"""
+    return ' '.join(re.sub(r'[^\w\s]', ' ', theme.lower()).split())
+
+
+def cache_key(theme, age_group, child_name, story_length):
+    """Build the cache key for a generation request"""
+    # Stories written without a name can't be personalized, so keep them apart
+    audience = 'named' if child_name else 'anonymous'
+    return f'{normalize_theme(theme)}|{age_group}|{story_length}|{audience}'
+
+
+def templatize(result, child_name):
+    """Replace the child's name in a generated story with the placeholder"""
+    if not child_name:
+        return {'title': result['title'], 'content': result['content']}
+
+    pattern = re.compile(rf'\b{re.escape(child_name)}\b')
+    return {
+        'title': pattern.sub(NAME_PLACEHOLDER, result['title']),
+        'content': pattern.sub(NAME_PLACEHOLDER, result['content'])
+    }
+
+
+def personalize(template, child_name):
+    """Fill the placeholder in a cached story with the child's name"""
+    if not child_name:
+        return dict(template)
+
+    return {
+        'title': template['title'].replace(NAME_PLACEHOLDER, child_name),
+        'content': template['content'].replace(NAME_PLACEHOLDER, child_name)
+    }
+
+
+class MemoryBackend:
+    """Per-process LRU store"""
+
+    name = 'memory'
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._counters = {'hits': 0, 'misses': 0}
+        self._lock = threading.Lock()
+
+    def next_variant(self, key, variants, ttl):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            cutoff = time.time() - ttl
+            entry['variants'] = [v for v in entry['variants'] if v[0] >= cutoff]
+            if len(entry['variants']) < variants:
+                return None
+
+            self._entries.move_to_end(key)
+            index = entry['cursor'] % len(entry['variants'])
+            entry['cursor'] += 1
+            return dict(entry['variants'][index][1])
+
+    def add_variant(self, key, template, variants, max_keys):
+        with self._lock:
+            entry = self._entries.setdefault(key, {'variants': [], 'cursor': 0})
+            if len(entry['variants']) < variants:
+                entry['variants'].append((time.time(), dict(template)))
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > max_keys:
+                self._entries.popitem(last=False)
+
+    def incr(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, keys=len(self._entries))
+
+
+class SqliteBackend(SqliteFile):
+    """Store shared by every worker process through a SQLite file"""
+
+    name = 'sqlite'
+
+    def _create_schema(self, conn):
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS story_cache (
+                key TEXT NOT NULL,
+                variant INTEGER NOT NULL,
+                title TEXT NOT NULL,
+                content TEXT NOT NULL,
+                stored_at REAL NOT NULL,
+                PRIMARY KEY (key, variant)
+            );
+            CREATE TABLE IF NOT EXISTS story_cache_keys (
+                key TEXT PRIMARY KEY,
+                cursor INTEGER NOT NULL DEFAULT 0,
+                used_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS ix_story_cache_keys_used_at
+                ON story_cache_keys (used_at);
+            CREATE TABLE IF NOT EXISTS story_cache_counters (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL DEFAULT 0
+            );
+            INSERT OR IGNORE INTO story_cache_counters (name, value)
+                VALUES ('hits', 0), ('misses', 0);
+        """)
+
+    def next_variant(self, key, variants, ttl):
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute(
+                'DELETE FROM story_cache WHERE key = ? AND stored_at < ?',
+                (key, time.time() - ttl)
+            )
+            rows = conn.execute(
+                'SELECT title, content FROM story_cache WHERE key = ? ORDER BY variant',
+                (key,)
+            ).fetchall()
+            if len(rows) < variants:
+                conn.execute('COMMIT')
+                return None
+
+            cursor = conn.execute(
+                'SELECT cursor FROM story_cache_keys WHERE key = ?', (key,)
+            ).fetchone()
+            cursor = cursor[0] if cursor else 0
+            conn.execute(
+                'UPDATE story_cache_keys SET cursor = ?, used_at = ? WHERE key = ?',
+                (cursor + 1, time.time(), key)
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+        title, content = rows[cursor % len(rows)]
+        return {'title': title, 'content': content}
+
+    def add_variant(self, key, template, variants, max_keys):
+        conn = self._conn()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            count, last = conn.execute(
+                'SELECT COUNT(*), COALESCE(MAX(variant), -1) FROM story_cache WHERE key = ?',
+                (key,)
+            ).fetchone()
+            if count < variants:
+                conn.execute(
+                    'INSERT INTO story_cache (key, variant, title, content, stored_at) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    (key, last + 1, template['title'], template['content'], now)
+                )
+            conn.execute(
+                'INSERT INTO story_cache_keys (key, used_at) VALUES (?, ?) '
+                'ON CONFLICT (key) DO UPDATE SET used_at = excluded.used_at',
+                (key, now)
+            )
+
+            # Evict the least recently used keys beyond the limit
+            stale = conn.execute(
+                'SELECT key FROM story_cache_keys ORDER BY used_at DESC LIMIT -1 OFFSET ?',
+                (max_keys,)
+            ).fetchall()
+            for (stale_key,) in stale:
+                conn.execute('DELETE FROM story_cache WHERE key = ?', (stale_key,))
+                conn.execute('DELETE FROM story_cache_keys WHERE key = ?', (stale_key,))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def incr(self, counter):
+        self._conn().execute(
+            'UPDATE story_cache_counters SET value = value + 1 WHERE name = ?', (counter,)
+        )
+
+    def stats(self):
+        conn = self._conn()
+        counters = dict(conn.execute('SELECT name, value FROM story_cache_counters'))
+        keys = conn.execute('SELECT COUNT(*) FROM story_cache_keys').fetchone()[0]
+        return dict(counters, keys=keys)
+
+
+class StoryCache:
+    """Cache of generated stories, personalized with the child's name on a hit"""
+
+    def __init__(self, backend, variants=1, ttl=86400, max_keys=500):
+        self.backend = backend
+        self.variants = max(1, variants)
+        self.ttl = ttl
+        self.max_keys = max_keys
+
+    def lookup(self, theme, age_group, child_name, story_length, partial=False):
+        """Return a cached story for the request, or None on a miss.
+
+        With ``partial`` any stored variant is served even if the key is not
+        full yet, for use as a fallback; such lookups are not counted.
+        """
+        key = cache_key(theme, age_group, child_name, story_length)
+        try:
+            template = self.backend.next_variant(key, 1 if partial else self.variants, self.ttl)
+            if not partial:
+                self.backend.incr('hits' if template else 'misses')
+        except sqlite3.Error:
+            logger.warning('Story cache lookup failed', exc_info=True)
+            return None
+
+        if template is None:
+            return None
+        return personalize(template, child_name)
+
+    def store(self, theme, age_group, child_name, story_length, result):
+        """Add a freshly generated story as a variant for its key"""
+        key = cache_key(theme, age_group, child_name, story_length)
+        try:
+            self.backend.add_variant(
+                key, templatize(result, child_name), self.variants, self.max_keys
+            )
+        except sqlite3.Error:
+            logger.warning('Story cache store failed', exc_info=True)
+
+    def stats(self):
+        """Hit/miss counters and key count"""
+        try:
+            stats = self.backend.stats()
+        except sqlite3.Error:
+            logger.warning('Story cache stats failed', exc_info=True)
+            return {'backend': self.backend.name}
+
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 3) if lookups else 0.0
+        stats['backend'] = self.backend.name
+        stats['variants'] = self.variants
+        return stats
+
+
+def create_cache(kind, path=None, variants=1, ttl=86400, max_keys=500):
+    """Build a StoryCache from configuration, or None when caching is off"""
+    kind = (kind or 'off').lower()
+    if kind in ('off', 'none', ''):
+        return None
+    if kind == 'memory':
+        backend = MemoryBackend()
+    elif kind == 'sqlite':
+        backend = SqliteBackend(path)
+    else:
+        raise ValueError(f"STORY_CACHE must be 'off', 'memory' or 'sqlite', got {kind!r}")
+    return StoryCache(backend, variants=variants, ttl=ttl, max_keys=max_keys)
@@ -0,0 +1,298 @@
+"""
+Protection around OpenAI calls.
+
+``RateLimiter`` is a token bucket with a requests-per-minute budget and a
+tokens-per-minute budget. Its state can live in a SQLite file so that
+every worker process draws from the same budget. ``CircuitBreaker`` stops
+calling upstream after repeated failures, so callers can degrade at once
+instead of waiting for timeouts. ``call_with_retry`` retries transient
+errors with jittered exponential backoff.
+"""
+import random
+import threading
+import time
+
+from sqlite_file import SqliteFile
+
+
+class UpstreamUnavailable(Exception):
+    """OpenAI was not called because it is failing or the budget is spent"""
+
+
+class CircuitOpen(UpstreamUnavailable):
+    pass
+
+
+class BudgetExhausted(UpstreamUnavailable):
+    pass
+
+
+def is_transient(error):
+    """Whether an OpenAI error is worth retrying.
+
+    Timeouts, connection errors, 5xx responses and rate limits are. Quota,
+    authentication and request errors are not, since retrying can't fix them.
+    """
+    import openai
+
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    if isinstance(error, openai.RateLimitError):
+        return getattr(error, 'code', None) != 'insufficient_quota'
+    status = getattr(error, 'status_code', None)
+    return status is not None and status >= 500
+
+
+def retry_after(error):
+    """Seconds the server asked us to wait, if it said"""
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+def call_with_retry(func, max_retries=3, base_delay=0.5, max_delay=8.0, on_retry=None):
+    """Call ``func``, retrying transient errors with full-jitter exponential backoff"""
+    for attempt in range(max_retries + 1):
+        try:
+            return func()
+        except Exception as e:
+            if attempt >= max_retries or not is_transient(e):
+                raise
+            delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+            delay = max(delay, retry_after(e) or 0)
+            if on_retry is not None:
+                on_retry(e, delay)
+            time.sleep(delay)
+
+
+class RateLimiter(SqliteFile):
+    """Requests-per-minute and tokens-per-minute token buckets.
+
+    A budget of 0 is unlimited. With ``path`` set the buckets are kept in a
+    SQLite file shared by all workers; otherwise they are per process.
+    """
+
+    def __init__(self, rpm=0, tpm=0, path=None, max_wait=10.0):
+        super().__init__(path)
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._state = None
+        self._waits = 0
+        self._rejected = 0
+
+    @property
+    def enabled(self):
+        return self.rpm > 0 or self.tpm > 0
+
+    def acquire(self, tokens):
+        """Wait until one request and ``tokens`` tokens fit the budget.
+
+        Raises ``BudgetExhausted`` if that would take longer than ``max_wait``.
+        """
+        if not self.enabled:
+            return
+        deadline = time.monotonic() + self.max_wait
+        waited = False
+        while True:
+            wait = self._take(tokens)
+            if wait <= 0:
+                if waited:
+                    with self._lock:
+                        self._waits += 1
+                return
+            if time.monotonic() + wait > deadline:
+                with self._lock:
+                    self._rejected += 1
+                raise BudgetExhausted(f'OpenAI budget exhausted; next slot in {wait:.1f}s')
+            waited = True
+            time.sleep(wait)
+
+    def refund(self, tokens):
+        """Return tokens that were reserved but not used"""
+        if self.enabled and self.tpm > 0 and tokens > 0:
+            self._update(lambda state, now: state.update(tokens=min(self.tpm, state['tokens'] + tokens)))
+
+    def pause(self, seconds):
+        """Stop handing out requests for a while, e.g. after a 429 with Retry-After"""
+        if self.enabled and seconds > 0:
+            until = time.time() + seconds
+            self._update(lambda state, now: state.update(paused_until=max(state['paused_until'], until)))
+
+    def stats(self):
+        if not self.enabled:
+            return {'enabled': False}
+        state = self._update(lambda state, now: None)
+        with self._lock:
+            return {
+                'enabled': True,
+                'shared': bool(self.path),
+                'rpm': self.rpm,
+                'tpm': self.tpm,
+                'requests_available': round(state['requests'], 1) if self.rpm else None,
+                'tokens_available': round(state['tokens']) if self.tpm else None,
+                'paused_seconds': round(max(0.0, state['paused_until'] - time.time()), 1),
+                'waits': self._waits,
+                'rejected': self._rejected
+            }
+
+    def _take(self, tokens):
+        """Reserve a request and tokens; returns 0, or the seconds to wait first"""
+        tokens = min(tokens, self.tpm) if self.tpm else 0
+
+        def take(state, now):
+            if state['paused_until'] > now:
+                return state['paused_until'] - now
+            waits = []
+            if self.rpm and state['requests'] < 1:
+                waits.append((1 - state['requests']) * 60.0 / self.rpm)
+            if self.tpm and state['tokens'] < tokens:
+                waits.append((tokens - state['tokens']) * 60.0 / self.tpm)
+            if waits:
+                return max(waits)
+            state['requests'] -= 1
+            state['tokens'] -= tokens
+            return 0
+
+        return self._update(take, result=True)
+
+    def _refill(self, state, now):
+        elapsed = max(0.0, now - state['updated'])
+        state['requests'] = min(self.rpm, state['requests'] + elapsed * self.rpm / 60.0)
+        state['tokens'] = min(self.tpm, state['tokens'] + elapsed * self.tpm / 60.0)
+        state['updated'] = now
+
+    def _update(self, change, result=False):
+        """Refill the buckets, apply ``change`` and save, atomically"""
+        now = time.time()
+        if not self.path:
+            with self._lock:
+                if self._state is None:
+                    self._state = self._full(now)
+                self._refill(self._state, now)
+                value = change(self._state, now)
+                return value if result else dict(self._state)
+
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                'SELECT requests, tokens, paused_until, updated FROM rate_limit WHERE id = 1'
+            ).fetchone()
+            state = self._full(now) if row is None else dict(
+                requests=row[0], tokens=row[1], paused_until=row[2], updated=row[3]
+            )
+            self._refill(state, now)
+            value = change(state, now)
+            conn.execute(
+                'INSERT OR REPLACE INTO rate_limit (id, requests, tokens, paused_until, updated) '
+                'VALUES (1, ?, ?, ?, ?)',
+                (state['requests'], state['tokens'], state['paused_until'], state['updated'])
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return value if result else state
+
+    def _full(self, now):
+        return {'requests': float(self.rpm), 'tokens': float(self.tpm), 'paused_until': 0.0, 'updated': now}
+
+    def _create_schema(self, conn):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS rate_limit (
+                id INTEGER PRIMARY KEY,
+                requests REAL NOT NULL,
+                tokens REAL NOT NULL,
+                paused_until REAL NOT NULL,
+                updated REAL NOT NULL
+            )
+        """)
+
+
+class CircuitBreaker:
+    """Opens after ``failure_threshold`` consecutive failures.
+
+    While open, ``before_call`` raises ``CircuitOpen`` until ``reset_seconds``
+    have passed. After that, one trial call is let through (half-open): its
+    success closes the circuit and its failure opens it again.
+    """
+
+    def __init__(self, failure_threshold=5, reset_seconds=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self._times_opened = 0
+        self._rejected = 0
+        self._last_error = None
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def before_call(self):
+        if self.failure_threshold <= 0:
+            return
+        with self._lock:
+            state = self._state()
+            if state == 'closed':
+                return
+            if state == 'half_open' and not self._trial_running:
+                self._trial_running = True
+                return
+            self._rejected += 1
+        raise CircuitOpen('OpenAI is failing; calls are paused')
+
+    def cancel_call(self):
+        """Forget a call that was let through but never reached upstream"""
+        with self._lock:
+            self._trial_running = False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self, error):
+        with self._lock:
+            self._failures += 1
+            self._last_error = type(error).__name__
+            if self._trial_running or (
+                self.failure_threshold > 0 and self._failures >= self.failure_threshold and self._opened_at is None
+            ):
+                self._opened_at = time.monotonic()
+                self._times_opened += 1
+            self._trial_running = False
+
+    def stats(self):
+        with self._lock:
+            state = self._state()
+            retry_in = None
+            if state == 'open':
+                retry_in = round(self._opened_at + self.reset_seconds - time.monotonic(), 1)
+            return {
+                'state': state,
+                'consecutive_failures': self._failures,
+                'failure_threshold': self.failure_threshold,
+                'retry_in_seconds': retry_in,
+                'times_opened': self._times_opened,
+                'rejected_calls': self._rejected,
+                'last_error': self._last_error
+            }
+
+    def _state(self):
+        if self._opened_at is None:
+            return 'closed'
+        if time.monotonic() - self._opened_at >= self.reset_seconds:
+            return 'half_open'
+        return 'open'
@@ -0,0 +1,346 @@
+"""
+Warm pool of pre-generated stories for popular requests.
+
+Recent requests are tallied per (theme, age group, length, named or not),
+and the combinations that belong to the most popular themes get a few
+stories generated ahead of time, in proportion to how often they are asked
+for. Pooled stories keep a placeholder where the child's name goes, so a
+request takes one out in O(1) and fills in its own name. Unlike the
+generation cache, each pooled story is served once, and it carries the
+tokens its refill used so the story that consumes it is charged for them;
+stories left in the pool past ``max_age`` are dropped rather than served.
+
+A background thread tops the pool up while the worker has no more than a
+few live generations running, within an hourly budget that counts every
+OpenAI request a refill makes. With a SQLite path the pool and the budget
+are shared by every worker.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+
+from sqlite_file import SqliteFile
+from story_cache import NAME_PLACEHOLDER, cache_key, normalize_theme, personalize, templatize
+
+logger = logging.getLogger(__name__)
+
+# Name the pool's stories are written for, swapped for the placeholder afterwards
+STAND_IN_NAME = 'Juniper'
+
+# OpenAI usage of a refill, kept with its story
+USAGE_FIELDS = ('prompt_tokens', 'completion_tokens')
+
+
+class MemoryStore:
+    """Per-process pool"""
+
+    name = 'memory'
+
+    def __init__(self):
+        self._stories = {}
+        self._spend = deque()
+        self._lock = threading.Lock()
+
+    def pop(self, key, since):
+        with self._lock:
+            stories = self._stories.get(key)
+            # Oldest first, so an expired head waits for the next expire()
+            if stories and stories[0][0] >= since:
+                return stories.popleft()[1]
+            return None
+
+    def push(self, key, template):
+        with self._lock:
+            self._stories.setdefault(key, deque()).append((time.time(), dict(template)))
+
+    def expire(self, before):
+        with self._lock:
+            expired = 0
+            for stories in self._stories.values():
+                while stories and stories[0][0] < before:
+                    stories.popleft()
+                    expired += 1
+            return expired
+
+    def levels(self):
+        with self._lock:
+            return {key: len(stories) for key, stories in self._stories.items() if stories}
+
+    def record_spend(self, calls=1):
+        with self._lock:
+            self._spend.extend([time.time()] * calls)
+
+    def spent_since(self, since):
+        with self._lock:
+            while self._spend and self._spend[0] < since:
+                self._spend.popleft()
+            return len(self._spend)
+
+
+class SqliteStore(SqliteFile):
+    """Pool shared by every worker process through a SQLite file"""
+
+    name = 'sqlite'
+
+    def _create_schema(self, conn):
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS warm_pool (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                key TEXT NOT NULL,
+                title TEXT NOT NULL,
+                content TEXT NOT NULL,
+                created REAL NOT NULL,
+                prompt_tokens INTEGER,
+                completion_tokens INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS ix_warm_pool_key_id ON warm_pool (key, id);
+            CREATE INDEX IF NOT EXISTS ix_warm_pool_created ON warm_pool (created);
+            CREATE TABLE IF NOT EXISTS warm_pool_spend (
+                at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS ix_warm_pool_spend_at ON warm_pool_spend (at);
+        """)
+        # Pools created before usage was recorded lack its columns
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(warm_pool)')}
+        for field in USAGE_FIELDS:
+            if field not in columns:
+                conn.execute(f'ALTER TABLE warm_pool ADD COLUMN {field} INTEGER')
+
+    def pop(self, key, since):
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                'SELECT id, title, content, prompt_tokens, completion_tokens FROM warm_pool '
+                'WHERE key = ? AND created >= ? ORDER BY id LIMIT 1', (key, since)
+            ).fetchone()
+            if row is not None:
+                conn.execute('DELETE FROM warm_pool WHERE id = ?', (row[0],))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        if row is None:
+            return None
+        return {'title': row[1], 'content': row[2], 'prompt_tokens': row[3], 'completion_tokens': row[4]}
+
+    def push(self, key, template):
+        self._conn().execute(
+            'INSERT INTO warm_pool (key, title, content, created, prompt_tokens, completion_tokens) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (key, template['title'], template['content'], time.time(),
+             template.get('prompt_tokens'), template.get('completion_tokens'))
+        )
+
+    def expire(self, before):
+        return self._conn().execute('DELETE FROM warm_pool WHERE created < ?', (before,)).rowcount
+
+    def levels(self):
+        return dict(self._conn().execute('SELECT key, COUNT(*) FROM warm_pool GROUP BY key'))
+
+    def record_spend(self, calls=1):
+        now = time.time()
+        self._conn().executemany('INSERT INTO warm_pool_spend (at) VALUES (?)', [(now,)] * calls)
+
+    def spent_since(self, since):
+        conn = self._conn()
+        conn.execute('DELETE FROM warm_pool_spend WHERE at < ?', (since,))
+        return conn.execute('SELECT COUNT(*) FROM warm_pool_spend').fetchone()[0]
+
+
+class WarmPool:
+    """Ready-made stories for the most requested popular combinations.
+
+    ``generate(theme, age_group, child_name, story_length)`` must call
+    OpenAI directly, bypassing this pool and the generation cache.
+    Its result carries ``openai_calls``, the requests it made, which are
+    charged to the hourly budget. ``top_themes()`` returns the names of the
+    most popular themes and is called inside an app context. Pooled stories
+    older than ``max_age`` seconds are dropped instead of served.
+    """
+
+    def __init__(self, app, store, generate, top_themes, size=0, max_per_key=5,
+                 budget_per_hour=60, interval=10.0, window=3600, max_live=0, max_age=86400):
+        self.app = app
+        self.store = store
+        self.generate = generate
+        self.top_themes = top_themes
+        self.size = size
+        self.max_per_key = max_per_key
+        self.budget_per_hour = budget_per_hour
+        self.interval = interval
+        self.window = window
+        self.max_live = max_live
+        self.max_age = max_age
+        self._demand = deque(maxlen=10000)
+        self._params = {}
+        self._targets = {}
+        self._live = 0
+        self._counters = Counter()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def enabled(self):
+        return self.size > 0
+
+    def take(self, theme, age_group, child_name, story_length):
+        """A pooled story personalized for the request, or None; the request counts towards demand"""
+        if not self.enabled:
+            return None
+
+        key = cache_key(theme, age_group, child_name, story_length)
+        with self._lock:
+            self._demand.append((time.time(), key))
+            self._params[key] = (theme, age_group, bool(child_name), story_length)
+
+        try:
+            template = self.store.pop(key, time.time() - self.max_age)
+        except sqlite3.Error:
+            logger.warning('Warm pool lookup failed', exc_info=True)
+            template = None
+        with self._lock:
+            self._counters['hits' if template else 'misses'] += 1
+        if template is None:
+            return None
+        return dict(personalize(template, child_name), **{field: template.get(field) for field in USAGE_FIELDS})
+
+    @contextmanager
+    def live(self):
+        """Mark a user-facing generation as running, which holds back refills"""
+        with self._lock:
+            self._live += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._live -= 1
+
+    def start(self):
+        """Start the refill thread for this process if it isn't running"""
+        if not self.enabled or self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name=f'warm-pool-{os.getpid()}', daemon=True)
+            self._thread.start()
+
+    def targets(self, top_themes):
+        """Stories to keep per key: the pool size split by each key's share of recent demand"""
+        top = {normalize_theme(theme) for theme in top_themes}
+        cutoff = time.time() - self.window
+        with self._lock:
+            while self._demand and self._demand[0][0] < cutoff:
+                self._demand.popleft()
+            counts = Counter(key for _, key in self._demand)
+            self._params = {key: params for key, params in self._params.items() if key in counts}
+
+        counts = {key: count for key, count in counts.items() if key.split('|')[0] in top}
+        total = sum(counts.values())
+        return {
+            key: min(self.max_per_key, max(1, round(self.size * count / total)))
+            for key, count in counts.items()
+        }
+
+    def refill(self):
+        """Generate stories for the keys furthest below target; returns how many were added"""
+        targets = self.targets(self.top_themes())
+        expired = self.store.expire(time.time() - self.max_age)
+        levels = self.store.levels()
+        with self._lock:
+            self._targets = targets
+            self._counters['expired'] += expired
+            params = dict(self._params)
+
+        added = 0
+        for key, target in sorted(targets.items(), key=lambda item: levels.get(item[0], 0) - item[1]):
+            if key not in params:
+                continue
+            theme, age_group, named, story_length = params[key]
+            name = STAND_IN_NAME if named else None
+            while levels.get(key, 0) < target:
+                if not self._idle() or self.store.spent_since(time.time() - 3600) >= self.budget_per_hour:
+                    return added
+                # One call is charged up front so other workers see it while this one runs;
+                # separate titles and title fallbacks make a second
+                self.store.record_spend()
+                result = self.generate(theme, age_group, name, story_length)
+                if result.get('openai_calls', 1) > 1:
+                    self.store.record_spend(result['openai_calls'] - 1)
+                if not result.get('success') or result.get('degraded'):
+                    # OpenAI is struggling; leave it to live traffic until the next round
+                    with self._lock:
+                        self._counters['failed'] += 1
+                    return added
+
+                template = dict(templatize(result, name), **{field: result.get(field) for field in USAGE_FIELDS})
+                if named and NAME_PLACEHOLDER not in template['content']:
+                    # The story never used the name, so it can't be personalized
+                    with self._lock:
+                        self._counters['discarded'] += 1
+                    continue
+                self.store.push(key, template)
+                levels[key] = levels.get(key, 0) + 1
+                added += 1
+                with self._lock:
+                    self._counters['generated'] += 1
+        return added
+
+    def stats(self):
+        """Fill level against target per key, hit rate and spend"""
+        if not self.enabled:
+            return {'enabled': False}
+        try:
+            levels = self.store.levels()
+            spent = self.store.spent_since(time.time() - 3600)
+        except sqlite3.Error:
+            logger.warning('Warm pool stats failed', exc_info=True)
+            levels, spent = {}, None
+
+        with self._lock:
+            counters = dict(self._counters)
+            targets = dict(self._targets)
+        lookups = counters.get('hits', 0) + counters.get('misses', 0)
+        return {
+            'enabled': True,
+            'backend': self.store.name,
+            'size': self.size,
+            'stories': sum(levels.values()),
+            'hits': counters.get('hits', 0),
+            'misses': counters.get('misses', 0),
+            'hit_rate': round(counters.get('hits', 0) / lookups, 3) if lookups else 0.0,
+            'generated': counters.get('generated', 0),
+            'failed': counters.get('failed', 0),
+            'discarded': counters.get('discarded', 0),
+            'expired': counters.get('expired', 0),
+            'spent_last_hour': spent,
+            'budget_per_hour': self.budget_per_hour,
+            'keys': {
+                key: {'stories': levels.get(key, 0), 'target': targets.get(key, 0)}
+                for key in sorted(set(levels) | set(targets))
+            }
+        }
+
+    def _idle(self):
+        with self._lock:
+            return self._live <= self.max_live
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                with self.app.app_context():
+                    self.refill()
+            except Exception:
+                logger.exception('Warm pool refill failed')
+
+
+def create_pool(app, generate, top_themes, path=None, **options):
+    """Build a WarmPool with a shared SQLite store when ``path`` is set"""
+    store = SqliteStore(path) if path else MemoryStore()
+    return WarmPool(app, store, generate, top_themes, **options)